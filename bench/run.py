@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# vim:set expandtab ts=4 sw=4 ai ft=python:
+
+"""
+Load-generation benchmark for the HTTP and facet layers.
+
+Starts a Server in this process against generated stub facets, then drives
+each facet from a separate client process (so the clients don't compete for
+the server's GIL) with keep-alive connections at each concurrency level.
+Reports requests/sec, latency percentiles and server RSS, as JSON:
+
+    python3 bench/run.py --levels 1,8,32 --seconds 10 --out bench.json
+
+Auth is stubbed out in-process; everything else is the production path.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import http.client
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from server.util import rss_mb
+
+# name -> (module source, request body)
+FACETS = {
+    'noop': ('''
+def handler(event, context):
+    return {"status": "success"}
+''', {}),
+    'cpu': ('''
+def handler(event, context):
+    total = 0
+    for num in range(event['parsed_body'].get('loops', 100000)):
+        total += num * num
+    return {"data": total}
+''', {"loops": 100000}),
+    'large': ('''
+def handler(event, context):
+    return {"data": event['parsed_body']['rows']}
+''', {"rows": [{"id": num, "score": num / 7, "label": "row-%d" % num}
+               for num in range(10000)]}),
+    'slowio': ('''
+import time
+def handler(event, context):
+    time.sleep(event['parsed_body'].get('sleep', 0.05))
+    return {"status": "success"}
+''', {"sleep": 0.05}),
+}
+
+################################################################################
+def make_facets(base):
+    """write the stub facets as polyform 'bench' under base"""
+    for name, (source, _) in FACETS.items():
+        path = os.path.join(base, "bench", name)
+        os.makedirs(path)
+        # module names must be unique across facets (and not shadow main.py)
+        with open(os.path.join(path, "bench_" + name + ".py"), "w") as outfile:
+            outfile.write(source)
+        with open(os.path.join(path, "_polyform.json"), "w") as outfile:
+            json.dump({"target": "bench", "forms": {
+                "bench": {"run": "bench_" + name + ".handler"}}}, outfile)
+
+def free_port():
+    """an unused localhost port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(base, port, conf):
+    """a Server on port, in this process, with auth stubbed"""
+    conf = dict(conf)
+    conf['server'] = dict(conf.get('server', {}), host='127.0.0.1', port=port,
+                          workers=1)
+    conf['polyform'] = dict(conf.get('polyform', {}), base=base)
+    os.environ['SERVER_CONFIG'] = json.dumps(conf)
+    import main as server_main # pylint: disable=import-outside-toplevel
+    from server import http as server_http # pylint: disable=import-outside-toplevel
+    server_http.lambda_proxy_auth = lambda event, context: {}
+    server = server_main.Server()
+    server.start(test=False, block=False)
+    return server
+
+################################################################################
+def client(port, path, body, seconds, results):
+    """one keep-alive connection, posting until time is up"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer bench'}
+    latencies = []
+    errors = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        started = time.perf_counter()
+        try:
+            conn.request('POST', path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    results.append((latencies, errors))
+
+# pylint: disable=too-many-arguments
+def drive(port, path, body, concurrency, seconds, queue):
+    """client process: concurrency threads, merged results on queue"""
+    results = []
+    threads = [threading.Thread(target=client,
+                                args=(port, path, body, seconds, results))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = sorted(lat for lats, _ in results for lat in lats)
+    queue.put((latencies, sum(errors for _, errors in results)))
+
+def percentile(values, pct):
+    """nearest-rank percentile of sorted values, in ms"""
+    if not values:
+        return None
+    idx = max(0, math.ceil(pct / 100 * len(values)) - 1)
+    return round(values[idx] * 1000, 3)
+
+def measure(port, facet, concurrency, seconds):
+    """one facet at one concurrency level"""
+    body = json.dumps(FACETS[facet][1]).encode()
+    path = "/api/v1/polyform/bench." + facet
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=drive,
+                       args=(port, path, body, concurrency, seconds, queue))
+    started = time.time()
+    proc.start()
+    latencies, errors = queue.get()
+    proc.join()
+    elapsed = time.time() - started
+    return {
+        'facet': facet,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / seconds, 1),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'rss_mb': round(rss_mb(), 1),
+        'wall_secs': round(elapsed, 2)
+    }
+
+################################################################################
+def arguments():
+    """the command line"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--facets", default=",".join(FACETS),
+                        help="comma separated, of: " + ",".join(FACETS))
+    parser.add_argument("--levels", default="1,4,16,64",
+                        help="comma separated client concurrency levels")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--config", default="{}",
+                        help="extra server config, as JSON (e.g. log or cache settings)")
+    parser.add_argument("--server-log", default=os.devnull,
+                        help="where the server's log lines go")
+    parser.add_argument("--out", default="-", help="JSON results file")
+    return parser.parse_args()
+
+def run_suite(args, base):
+    """every facet at every level, against a server on facets under base"""
+    make_facets(base)
+    port = free_port()
+    report = sys.stderr
+    results = []
+    with open(args.server_log, "a") as server_log:
+        sys.stdout = server_log
+        try:
+            start_server(base, port, json.loads(args.config))
+            for facet in args.facets.split(","):
+                for level in [int(level) for level in args.levels.split(",")]:
+                    result = measure(port, facet, level, args.seconds)
+                    print("{facet:8} c={concurrency:<4} {rps:>9} rps  p50={p50_ms}ms "
+                          "p95={p95_ms}ms p99={p99_ms}ms  rss={rss_mb}MB errors={errors}"
+                          .format(**result), file=report)
+                    results.append(result)
+        finally:
+            import cherrypy # pylint: disable=import-outside-toplevel
+            cherrypy.engine.exit()
+            sys.stdout = sys.__stdout__
+    return results
+
+def main():
+    """run the suite"""
+    args = arguments()
+    started = time.time()
+    with tempfile.TemporaryDirectory(prefix="polyapi-bench-") as base:
+        results = run_suite(args, base)
+
+    doc = json.dumps({'started': started, 'python': sys.version.split()[0],
+                      'seconds': args.seconds, 'config': json.loads(args.config),
+                      'results': results}, indent=2)
+    if args.out == "-":
+        print(doc)
+    else:
+        with open(args.out, "w") as outfile:
+            outfile.write(doc + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ General Webhooks and simple API routing
 import os
 import sys
 import time
+import signal
 #import importlib
 import base64
 import logging
@@ -25,7 +26,7 @@ import timeinterval
 import dictlib
 from dictlib import Dict
 from server.util import json2data
-from server import http, SERVER, logger
+from server import http, workers as prefork, SERVER, logger, tracing, load
 
 ################################################################################
 class Server():
@@ -38,6 +39,8 @@ class Server():
                        #dbm=dictlib.Obj(count=0),
                        next_report=0, last_rusage=None)
     mgr = None
+    sizer = None
+    supervisor = None
     cherry = None
     endpoints = None
     endpoint_conf = None
@@ -50,6 +53,8 @@ class Server():
             '/': {
                 'response.headers.server': "stack",
                 'tools.secureheaders.on': True,
+                'tools.trace.on': True,
+                'tools.auth_throttle.on': True,
                 'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
                 'request.method_with_bodies': ('PUT', 'POST', 'PATCH'),
             }
@@ -106,17 +111,20 @@ class Server():
             "isrss":round((cur.ru_isrss-last.ru_isrss)/1024, 2),
             "threads":threading.active_count()
         }
+        if self.sizer:
+            report.update(self.sizer.report())
 
         self.stat.last_rusage = cur
         self.stat.next_report = self.stat.heartbeat.last + self.conf['status_report']
 
         return report
 
-    def add_endpoint(self, endpoint, mod):
-        """add an endpoint as a pluggable module"""
+    def add_endpoint(self, endpoint, mod, route=None):
+        """add an endpoint as a pluggable module, at route_base/<module> unless given"""
         # pylint: disable=no-member
 #        mod = importlib.import_module('endpoints.' + endpoint, package='.') # , package=__name__)
-        route = self.conf.server.route_base + "/" + mod.__name__.split(".")[-1]
+        if not route:
+            route = self.conf.server.route_base + "/" + mod.__name__.split(".")[-1]
         print("route=" + route)
         handler = mod.Handler(server=self, route=route)
         print("handler={}".format(handler))
@@ -124,10 +132,11 @@ class Server():
         self.endpoints.append(Dict(name=endpoint, mod=mod, handler=handler, route=route))
 
     # pylint: disable=too-many-locals,too-many-statements
-    def start(self, test=True):
+    def start(self, test=True, workers=None, block=True):
         """
         Startup script for webhook routing.
-        Called from agent start
+        Called from agent start; with block=False it returns once listening
+        (for running in-process, as bench/run.py does)
         """
 
         cherrypy.log = logger.CherryLog()
@@ -176,20 +185,77 @@ class Server():
             'server': {
                 'route_base': '/api/v1',
                 'port': 64000,
-                'host': '0.0.0.0'
+                'host': '0.0.0.0',
+                'workers': 1,
+                'max_body_mb': 100, # raise for facets that ingest big streams
+                'threads': {
+                    'min': 10,     # CherryPy's default, fixed unless adaptive
+                    'max': 100,
+                    'adaptive': False,
+                    'interval': 5, # seconds between sizing decisions
+                    'cpu_bound': 0.8 # cores busy in facets past which threads don't help
+                }
+            },
+            'log': {
+                'buffered': False, # queue log lines to a writer thread
+                'queue': 10000,
+                'batch': 512,
+                'policy': 'drop'   # or 'block' when the queue is full
             },
             'heartbeat': 10,
+            'ready': {             # /ready, for load balancers
+                'max_saturation': 1.0,
+                'max_p95_ms': 0,   # latency that counts as saturated, 0 ignores it
+                'window': 60       # seconds of latency the p95 covers
+            },
             'status_report': 3600, # every hour
             'requestid': True,
+            'trace': {
+                'export': False,   # log a type=trace record per request
+                'min_ms': 0        # ... taking at least this long
+            },
             'refresh_maps': 300,
             'cache': {
                 'housekeeper': 60,
                 'policies': 300,
                 'sessions': 300,
-                'groups': 300
+                'groups': 300,
+                'results': {       # facets opt in with "cache" in their form
+                    'ttl': 300,
+                    'max_mb': 64
+                }
             },
             'auth': {
-                'expires': 300
+                'expires': 300,
+                'admin_scope': 'polyapi:admin', # needed for /admin routes
+                'throttle': {      # failed auth, per client address
+                    'burst': 5,
+                    'window': 60,
+                    'max_delay': 300
+                }
+            },
+            'jobs': {              # POST ...?async=true
+                'workers': 4,
+                'queue': 64,
+                'ttl': 3600,       # keep finished results this long
+                'spool': ''        # directory shared by --workers, needed for async there
+            },
+            'gateway': {           # set backends to run as a gateway
+                'backends': [],    # e.g. ["http://10.0.0.5:64000"]
+                'spread': 2,       # nodes per facet to balance across
+                'vnodes': 64,
+                'pool': 8,         # keep-alive connections per backend
+                'timeout': 30,
+                'connect_timeout': 2, # past this a node is down: try the next
+                'check': 5,        # seconds between backend health checks
+                'probe_timeout': 2
+            },
+            'polyform': {
+                'base': './polys',
+                'lazy': False,     # import facets on first call
+                'loaded_max': 0,   # lazy LRU bound, 0 is unbounded
+                'warm_threads': 4, # parallel warm-up at boot
+                'watch': 0         # seconds between _polyform.json checks, 0 is off
             }
         }
 
@@ -219,29 +285,16 @@ class Server():
             logger.log("Unable to find configuration, using defaults!")
             conf = Dict(defaults)
 
-        # cherry py global
-        cherry_conf = {
-            'server.socket_port': 64000,
-            'server.socket_host': '0.0.0.0'
-        }
-
-        if dictlib.dig_get(conf, 'server.port'): # .get('port'):
-            cherry_conf['server.socket_port'] = int(conf.server.port)
-        if dictlib.dig_get(conf, 'server.host'): # .get('host'):
-            cherry_conf['server.socket_host'] = conf.server.host
-
-        # if production mode
-        if test:
-            logger.log("Test mode enabled", type="notice")
-            conf['test_mode'] = True
-        else:
-            cherry_conf['environment'] = 'production'
-            conf['test_mode'] = False
+        cherry_conf = self._cherry_conf(conf, test)
 
         sys.stdout.flush()
         cherrypy.config.update(cherry_conf)
         cherrypy.config.update({'engine.autoreload.on': False})
+        if workers:
+            conf.server.workers = workers
         self.conf = conf
+        http.THROTTLE.configure(**conf.auth.throttle)
+        tracing.configure(**conf.trace)
 
         sys.path.append('.')
 
@@ -251,8 +304,29 @@ class Server():
 
         # hack for now
 #        from . import polyform as polyform
-        from server.endpoints import polyform
-        self.add_endpoint('polyform', polyform)
+        # before facets are imported, which may open files of their own
+        self._bind(cherry_conf)
+
+        if conf.gateway.backends:
+            # route calls to other nodes instead of running facets here
+            from server.endpoints import gateway
+            self.add_endpoint('gateway', gateway,
+                              route=conf.server.route_base + "/polyform")
+        else:
+            from server.endpoints import polyform, admin
+            self.add_endpoint('polyform', polyform)
+            self.add_endpoint('admin', admin)
+
+        # facets are imported: fork now, before any threads are started,
+        # so workers share the loaded models copy-on-write
+        self._fork()
+        # a deploy (or the supervisor, for a worker) stops us with SIGTERM:
+        # exit the engine so its 'stop' hooks, like draining the log, run
+        signal.signal(signal.SIGTERM, _terminate)
+
+        if conf.log.buffered:
+            logger.start_writer(size=conf.log.queue, batch=conf.log.batch,
+                                policy=conf.log.policy)
 
         # startup cleaning interval
         def housekeeper(server):
@@ -267,6 +341,14 @@ class Server():
         cherrypy.tree.mount(http.Health(server=self),
                             conf.server.route_base + "/health",
                             self.endpoint_conf)
+        cherrypy.tree.mount(http.Ready(server=self),
+                            conf.server.route_base + "/ready",
+                            self.endpoint_conf)
+        cherrypy.tree.mount(http.Metrics(server=self),
+                            conf.server.route_base + "/metrics",
+                            self.endpoint_conf)
+
+        self._size_threads()
 
         int_mon = cherrypy.process.plugins.Monitor(cherrypy.engine,
                                                    self.monitor,
@@ -276,7 +358,60 @@ class Server():
         # whew, now start the server
         logger.log("Base path={}".format(conf.server.route_base), type="notice")
         cherrypy.engine.start()
-        cherrypy.engine.block()
+        if block:
+            cherrypy.engine.block()
+
+    # pylint: disable=no-self-use
+    def _cherry_conf(self, conf, test):
+        """CherryPy's global config: the listening socket and its thread pool"""
+        cherry_conf = {
+            'server.socket_port': 64000,
+            'server.socket_host': '0.0.0.0'
+        }
+
+        if dictlib.dig_get(conf, 'server.port'): # .get('port'):
+            cherry_conf['server.socket_port'] = int(conf.server.port)
+        if dictlib.dig_get(conf, 'server.host'): # .get('host'):
+            cherry_conf['server.socket_host'] = conf.server.host
+        cherry_conf['server.max_request_body_size'] = int(conf.server.max_body_mb * 1048576)
+        cherry_conf['server.thread_pool'] = int(conf.server.threads.min)
+        if conf.server.threads.adaptive:
+            cherry_conf['server.thread_pool_max'] = int(conf.server.threads.max)
+
+        # if production mode
+        if test:
+            logger.log("Test mode enabled", type="notice")
+            conf['test_mode'] = True
+        else:
+            cherry_conf['environment'] = 'production'
+            conf['test_mode'] = False
+        return cherry_conf
+
+    def _bind(self, cherry_conf):
+        """with pre-forked workers configured, bind the socket they will share"""
+        if int(self.conf.server.workers) > 1:
+            self.supervisor = prefork.Supervisor(int(self.conf.server.workers),
+                                                 cherry_conf['server.socket_host'],
+                                                 cherry_conf['server.socket_port'])
+            self.supervisor.bind()
+
+    def _fork(self):
+        """pre-fork worker processes sharing the listening socket, if configured"""
+        if self.supervisor:
+            self.supervisor.start()
+
+    def _size_threads(self):
+        """with adaptive threads, resize the pool every interval"""
+        threads = self.conf.server.threads
+        if threads.adaptive:
+            self.sizer = load.PoolSizer(cpu_bound=threads.cpu_bound)
+            cherrypy.process.plugins.Monitor(cherrypy.engine, self.sizer.tick,
+                                             frequency=threads.interval,
+                                             name="threadpool").subscribe()
+
+def _terminate(_signum, _frame):
+    """SIGTERM: shut down cleanly"""
+    cherrypy.engine.exit()
 
 ################################################################################
 def main():
@@ -285,6 +420,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action='append')
     parser.add_argument("--test", action='store_true')
+    parser.add_argument("--workers", type=int,
+                        help="pre-fork this many worker processes")
 
     args = parser.parse_args()
 
@@ -296,7 +433,7 @@ def main():
     setproctitle.setproctitle('polyapi') # pylint: disable=no-member,c-extension-no-member
 
     SERVER = Server()
-    SERVER.start(test=args.test)
+    SERVER.start(test=args.test, workers=args.workers)
 
 ################################################################################
 if __name__ == "__main__":
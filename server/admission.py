@@ -0,0 +1,68 @@
+"""
+Per-facet concurrency limits
+"""
+
+import time
+import threading
+from . import exceptions
+
+################################################################################
+class Admission():
+    """
+    Concurrency limit for one facet.
+
+    Up to `limit` calls run at once and up to `queue` more wait, each for at
+    most `timeout` seconds.  Anything beyond that is refused straight away
+    (exceptions.Overloaded: 503 with Retry-After), so one saturated heavy
+    facet can't occupy every worker thread.
+    """
+    limit = 1
+    queue = 0
+    timeout = 30
+    retry_after = 1
+
+    def __init__(self, limit=1, queue=0, timeout=30, retry_after=1):
+        self.limit = max(1, int(limit))
+        self.queue = int(queue)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.cond = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+
+    def _refuse(self, why):
+        """raise the overload"""
+        raise exceptions.Overloaded(why, 503, self.retry_after)
+
+    def acquire(self):
+        """take a slot, waiting if allowed; returns the seconds spent queued"""
+        started = time.time()
+        with self.cond:
+            if self.running < self.limit and not self.waiting:
+                self.running += 1
+                return 0.0
+            if self.waiting >= self.queue:
+                self._refuse("Facet is at capacity, try again later")
+            self.waiting += 1
+            try:
+                deadline = started + self.timeout
+                while self.running >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._refuse("Timed out waiting for facet capacity")
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+        return time.time() - started
+
+    def release(self):
+        """give the slot back"""
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+    def stats(self):
+        """current occupancy"""
+        return dict(running=self.running, waiting=self.waiting,
+                    limit=self.limit, queue=self.queue)
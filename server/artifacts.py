@@ -0,0 +1,55 @@
+"""
+Memory-mapped, read-only model artifacts
+"""
+
+import os
+import mmap
+import threading
+
+# optional: only needed for .npy artifacts
+try:
+    import numpy
+except ImportError: # pragma: no cover
+    numpy = None # pylint: disable=invalid-name
+
+LOCK = threading.Lock()
+MAPPED = dict() # realpath -> ((mtime_ns, size), artifact)
+
+################################################################################
+def load(path):
+    """
+    A read-only, memory-mapped artifact, shared by every caller in the
+    process.  A .npy file comes back as a numpy array, anything else as an
+    mmap (a bytes-like buffer, for libraries that load models from memory).
+
+    Pages are read from the page cache on first touch rather than copied
+    onto the heap, so the processes on a host share a single copy of each
+    file and loading is close to free.  A file replaced on disk (by rename;
+    never rewrite a mapped file in place) is mapped afresh on the next load.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with LOCK:
+        mapped = MAPPED.get(path)
+        if mapped and mapped[0] == version:
+            return mapped[1]
+        artifact = _map(path)
+        MAPPED[path] = (version, artifact)
+    return artifact
+
+def _map(path):
+    """map one file"""
+    if path.endswith(".npy"):
+        if numpy is None:
+            raise ValueError("numpy is needed to load {}".format(path))
+        return numpy.load(path, mmap_mode='r')
+    with open(path, 'rb') as infile:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+def stats():
+    """what is mapped"""
+    with LOCK:
+        return dict(files=len(MAPPED),
+                    mapped_mb=round(sum(version[1] for version, _ in MAPPED.values())
+                                    / 1048576, 1))
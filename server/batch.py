@@ -0,0 +1,111 @@
+"""
+Micro-batching of concurrent facet calls
+"""
+
+import time
+import threading
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class Batcher():
+    """
+    Collect concurrent calls to one facet into a single batch call.
+
+    The first caller to arrive leads: it waits up to `window` seconds (or
+    until `size` calls are queued), calls the facet's batch function once with
+    the list of events and hands every waiting caller its own result.  If
+    more calls arrived than fit, the oldest leftover is promoted to lead the
+    next batch.  No extra threads are involved.
+
+    The batch function takes (events, context) and returns a list of results
+    in the same order; an Exception in that list fails only its own caller.
+    """
+    size = 32
+    window = 0.005
+
+    def __init__(self, size=32, window=0.005):
+        self.size = max(1, int(size))
+        self.window = window
+        self.lock = threading.Lock()
+        self.full = threading.Condition(self.lock)
+        self.pending = []
+        self.leading = False
+
+    def call(self, func, event, context):
+        """queue one event and block until its result is ready"""
+        item = Pending(event)
+        with self.lock:
+            self.pending.append(item)
+            if not self.leading:
+                self.leading = True
+                item.lead = True
+            elif len(self.pending) >= self.size:
+                self.full.notify()
+
+        if not item.lead:
+            item.wake.wait()
+        if item.lead:
+            self._lead(func, context)
+        return item.get()
+
+    def _lead(self, func, context):
+        """gather a batch, run it, fan the results back out"""
+        deadline = time.monotonic() + self.window
+        with self.lock:
+            while len(self.pending) < self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.full.wait(remaining)
+            batch = self.pending[:self.size]
+            self.pending = self.pending[self.size:]
+            if self.pending:
+                self.pending[0].promote()
+            else:
+                self.leading = False
+
+        try:
+            results = func([item.event for item in batch], context)
+            if len(results) != len(batch):
+                raise ValueError("batch returned {} results for {} events"
+                                 .format(len(results), len(batch)))
+        except Exception as err: # pylint: disable=broad-except
+            for item in batch:
+                item.finish(error=err)
+            return
+
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                item.finish(error=result)
+            else:
+                item.finish(result=result)
+
+# pylint: disable=too-few-public-methods
+class Pending():
+    """one caller waiting on a batch"""
+    __slots__ = ('event', 'result', 'error', 'lead', 'wake')
+
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.error = None
+        self.lead = False
+        self.wake = threading.Event()
+
+    def promote(self):
+        """wake this caller to lead the next batch"""
+        self.lead = True
+        self.wake.set()
+
+    def finish(self, result=None, error=None):
+        """deliver the outcome"""
+        self.result = result
+        self.error = error
+        self.lead = False
+        self.wake.set()
+
+    def get(self):
+        """the outcome, raising a failure in the caller's thread"""
+        if self.error is not None:
+            raise self.error
+        return self.result
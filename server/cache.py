@@ -0,0 +1,102 @@
+"""
+In-memory caches
+"""
+
+import time
+import hashlib
+import threading
+import collections
+from .util import json4store
+
+################################################################################
+# pylint: disable=too-many-instance-attributes
+class TTLCache():
+    """
+    Thread-safe LRU with per-entry expiry and an approximate size cap.
+
+    Each entry carries a caller-supplied size (bytes, or 1 to count items);
+    once the total passes max_size the least recently used entries go.  A
+    max_size of zero is unbounded.  Expired entries are dropped when read,
+    and in bulk by prune() from the housekeeper.
+    """
+    ttl = 300
+    max_size = 0
+
+    def __init__(self, ttl=300, max_size=0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict() # key -> (expires, size, value)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """cached value, or None"""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, size=1, ttl=None):
+        """store a value, evicting as needed"""
+        if self.max_size and size > self.max_size:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            if key in self.data:
+                self._drop(key)
+            self.data[key] = (expires, size, value)
+            self.size += size
+            while self.max_size and self.size > self.max_size:
+                self._drop(next(iter(self.data)))
+                self.evictions += 1
+
+    def prune(self):
+        """drop expired entries, returning how many went"""
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self.data.items() if entry[0] < now]
+            for key in expired:
+                self._drop(key)
+        return len(expired)
+
+    def discard(self, match):
+        """drop every entry whose key match(key) is true"""
+        with self.lock:
+            keys = [key for key in self.data if match(key)]
+            for key in keys:
+                self._drop(key)
+        return len(keys)
+
+    def stats(self):
+        """counters for reporting"""
+        with self.lock:
+            return dict(items=len(self.data), size=self.size, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
+
+    def _drop(self, key):
+        """remove one entry, lock held"""
+        entry = self.data.pop(key)
+        self.size -= entry[1]
+
+################################################################################
+def body_key(body):
+    """
+    Canonical hash of a decoded request body, or None if it can't be
+    expressed as JSON (in which case it is not cacheable).
+    """
+    try:
+        canon = json4store(body, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(canon.encode()).hexdigest()
@@ -0,0 +1,98 @@
+"""
+Arrow IPC request and response bodies, for bulk scoring
+"""
+
+import cherrypy
+from .util import json4store, json4wire, json_processor
+from . import streaming, tracing
+
+# optional: only needed by clients that ask for it
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError: # pragma: no cover
+    pyarrow = None # pylint: disable=invalid-name
+
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+# request bodies the REST handlers take (see http.Rest)
+BODY_TYPES = ['application/json', 'text/javascript', ARROW_STREAM]
+
+################################################################################
+def decode(body):
+    """
+    An Arrow IPC stream to a pyarrow.Table.  The table's column buffers
+    point into the request body; nothing is copied or parsed row by row.
+    """
+    if pyarrow is None:
+        raise cherrypy.HTTPError(415, "Arrow bodies are not supported here (no pyarrow)")
+    with cherrypy.HTTPError.handle((pyarrow.ArrowInvalid, OSError), 400,
+                                   'Invalid Arrow IPC stream'):
+        return pyarrow.ipc.open_stream(pyarrow.py_buffer(body)).read_all()
+
+def _table(data):
+    """a pyarrow.Table from a table, a DataFrame or a dict of columns"""
+    if isinstance(data, pyarrow.Table):
+        return data
+    if hasattr(data, 'columns') and hasattr(data, 'to_numpy'):
+        return pyarrow.Table.from_pandas(data, preserve_index=False)
+    if isinstance(data, dict):
+        return pyarrow.table(data)
+    return None
+
+def encode(result):
+    """
+    A facet result as an Arrow IPC stream, or None when it isn't tabular.
+
+    The table is result['data']; the remaining keys (status and the like) go
+    along as JSON in the schema metadata under b'polyapi'.
+    """
+    if pyarrow is None or not isinstance(result, dict) or 'data' not in result:
+        return None
+    try:
+        table = _table(result['data'])
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError):
+        return None
+    if table is None:
+        return None
+
+    meta = {key: value for key, value in result.items() if key != 'data'}
+    table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                               polyapi=json4store(meta)))
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def accepts_arrow():
+    """did the client ask for an Arrow response?"""
+    return ARROW_STREAM in cherrypy.serving.request.headers.get('Accept', '')
+
+################################################################################
+def body_processor(entity):
+    """cherrypy.tools.json_in processor: JSON, or Arrow by Content-Type"""
+    with tracing.span('decode'):
+        if entity.content_type.value != ARROW_STREAM:
+            return json_processor(entity)
+        cherrypy.serving.request.json = decode(entity.fp.read())
+    return None
+
+def body_handler(*args, **kwargs):
+    """
+    cherrypy.tools.json_out handler: JSON, or Arrow if accepted and tabular,
+    or a chunked stream if the handler returned an iterator.  bytes are sent
+    as they are (the handler sets their Content-Type).
+    """
+    # pylint: disable=protected-access
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    if isinstance(value, bytes):
+        return value
+    if streaming.is_stream(value):
+        return streaming.respond(value)
+    with tracing.span('encode'):
+        if accepts_arrow():
+            body = encode(value)
+            if body is not None:
+                cherrypy.serving.response.headers['Content-Type'] = ARROW_STREAM
+                return body
+        return json4wire(value)
@@ -0,0 +1,66 @@
+"""
+Handler Admin
+"""
+
+import cherrypy
+from .. import exceptions
+from ..http import Endpoint, Rest, admin_auth
+from ..profiler import Sampler
+from . import polyform
+
+# longest a profile may run, in seconds: it holds a server thread throughout
+PROFILE_MAX = 300
+
+class Handler(Endpoint, Rest):
+    """operational actions, for tokens granted the admin scope"""
+
+    def rest_create(self, action, *args, **_kwargs):
+        """POST reload/<facet>: re-import one facet in the background"""
+        admin_auth(self)
+        if action != "reload" or len(args) != 1:
+            raise exceptions.ServerError("No such admin action", 404)
+
+        name = args[0]
+        if name not in polyform.POLYS:
+            raise exceptions.InvalidParameter("Cannot find polyform facet: {}".format(name))
+        if not polyform.start_reload(name):
+            raise exceptions.ServerError("Facet is already reloading", 409)
+        return self.respond({"status": "accepted", "facet": name}, status=202)
+
+    def rest_read(self, action, *args, **kwargs):
+        """GET reload/<facet>: how the last reload went; GET profile: see _profile"""
+        admin_auth(self)
+        if action == "profile" and not args:
+            return self._profile(**kwargs)
+        if action != "reload" or len(args) != 1:
+            raise exceptions.ServerError("No such admin action", 404)
+
+        status = polyform.RELOADING.facets.get(args[0])
+        if not status:
+            raise exceptions.ServerError("Facet has not been reloaded", 404)
+        if status.finished is None:
+            return self.respond(dict(status), status=202)
+        return self.respond(dict(status))
+
+    # pylint: disable=no-self-use
+    def _profile(self, seconds="10", interval_ms="10", threads="requests",
+                 format="collapsed", **_kwargs): # pylint: disable=redefined-builtin
+        """
+        GET profile?seconds=10&interval_ms=10: sample the stacks of threads
+        handling requests, labelled by facet (or route).  threads=all samples
+        every thread; format=json groups the stacks by label instead of
+        returning collapsed stacks for flamegraph.pl.
+        """
+        seconds = float(seconds)
+        if not 0 < seconds <= PROFILE_MAX:
+            raise ValueError("seconds must be more than 0 and at most {}".format(PROFILE_MAX))
+        sampler = Sampler(interval=max(1, float(interval_ms)) / 1000,
+                          every_thread=threads == "all")
+        if not sampler.run(seconds):
+            raise exceptions.ServerError("A profile is already running", 409)
+
+        if format == "json":
+            return self.respond({"status": "success", "seconds": seconds,
+                                 "ticks": sampler.ticks, "facets": sampler.by_label()})
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return sampler.collapsed().encode()
@@ -0,0 +1,137 @@
+"""
+Handler Gateway: /polyform/<facet> on a node that only routes
+"""
+
+import cherrypy
+from .. import exceptions, tracing
+from ..http import Endpoint
+from ..util import remote_addr, json4wire
+from ..gateway import Gateway
+
+# request and response headers passed along
+REQUEST_HEADERS = ('Content-Type', 'Accept', 'Authorization')
+RESPONSE_HEADERS = ('Content-Type', 'Retry-After', 'Location')
+
+class Handler(Endpoint):
+    """
+    Stands in for the polyform endpoint, forwarding each call as it is (the
+    body is never decoded here) to a backend chosen by the Gateway.  Auth is
+    left to the backends.
+    """
+    exposed = True
+    chunk = 65536
+
+    def __init__(self, server=None, **kwargs):
+        super().__init__(server=server, **kwargs)
+        conf = server.conf.gateway
+        self.gateway = Gateway(conf.backends, spread=int(conf.spread),
+                               vnodes=int(conf.vnodes), pool=int(conf.pool),
+                               timeout=conf.timeout,
+                               connect_timeout=conf.connect_timeout,
+                               probe_timeout=conf.probe_timeout)
+        self.gateway.check()
+        # runs with the engine, so each pre-forked worker checks for itself
+        cherrypy.process.plugins.Monitor(cherrypy.engine, self.gateway.check,
+                                         frequency=conf.check,
+                                         name="gateway-check").subscribe()
+
+    def health_detail(self):
+        """backends for /health?detail=true"""
+        return {'backends': self.gateway.stats()}
+
+    # pylint: disable=invalid-name
+    def POST(self, *args, **_kwargs):
+        """call a facet on a backend"""
+        if len(args) != 1:
+            return self._failed("POST to /polyform/<facet>", 400)
+        backends = self.gateway.choose(args[0])
+        if not backends:
+            return self._failed("Cannot find polyform facet: {}".format(args[0]), 404)
+        return self._forward(backends, cherrypy.request.body.read())
+
+    def GET(self, *args, **_kwargs):
+        """
+        jobs/<id>: the job lives on whichever backend ran it, so ask each
+        in turn until one knows it
+        """
+        if len(args) != 2 or args[0] != "jobs":
+            return self._failed("HTTP GET is only supported for jobs/<id>", 400)
+        for backend in self.gateway.backends:
+            if backend.healthy:
+                result = self._forward([backend], None, quiet=True)
+                if result is not None:
+                    return result
+        return self._failed("No such job (or it has expired)", 404)
+
+    # pylint: disable=no-self-use
+    def _failed(self, message, status):
+        """a failure, shaped like the backends' own"""
+        cherrypy.response.status = status
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json4wire({"status": "failed", "message": message})
+
+    def _forward(self, backends, body, quiet=False):
+        """relay the call and its response; with quiet, None on a 404 or failure"""
+        request = cherrypy.request
+        headers = {name: request.headers[name] for name in REQUEST_HEADERS
+                   if name in request.headers}
+        headers['X-Forwarded-For'] = remote_addr()
+        headers['X-Request-Id'] = getattr(request, 'reqid', '')
+        path = "/polyform" + request.path_info
+        if request.query_string:
+            path += "?" + request.query_string
+
+        try:
+            with tracing.span('backend'):
+                backend, conn, response = self.gateway.forward(
+                    backends, request.method, path, body, headers)
+        except exceptions.ServerError as err:
+            if quiet:
+                return None
+            return self._failed(err.args[0], err.args[1])
+
+        if response.getheader('Content-Length') is None:
+            # chunked: relay it as it comes
+            cherrypy.response.status = response.status
+            self._headers(response)
+            cherrypy.response.stream = True
+            return self._relay(backend, conn, response)
+
+        released = False
+        try:
+            content = response.read()
+            backend.release(conn, response)
+            released = True
+        finally:
+            if not released:
+                conn.close()
+            self.gateway.done(backend)
+        if quiet and response.status == 404:
+            return None
+        cherrypy.response.status = response.status
+        self._headers(response)
+        return content
+
+    # pylint: disable=no-self-use
+    def _headers(self, response):
+        """pass the backend's response headers along"""
+        for name in RESPONSE_HEADERS:
+            value = response.getheader(name)
+            if value:
+                cherrypy.response.headers[name] = value
+
+    def _relay(self, backend, conn, response):
+        """stream a chunked backend response"""
+        released = False
+        try:
+            while True:
+                block = response.read1(self.chunk)
+                if not block:
+                    break
+                yield block
+            backend.release(conn, response)
+            released = True
+        finally:
+            if not released:
+                conn.close()
+            self.gateway.done(backend)
@@ -3,26 +3,50 @@ Handler Polyforms
 """
 
 import os
-import sys
 import re
-import importlib
 import json
+import time
+import functools
+import itertools
+import threading
+import traceback
 import cherrypy
 from dictlib import Dict
-from .. import exceptions
+from .. import exceptions, artifacts, profiler, tracing
 from ..http import Endpoint, Rest, lambda_auth
+from ..facet import FacetContext, LoadedFacets, load_facet, unload_facet
+from ..batch import Batcher
+from ..cache import TTLCache, body_key
+from ..util import json4store
+from ..logger import log
+from ..metrics import METRICS
+from ..streaming import is_stream, RecordStream
+from ..jobs import Jobs
+from ..admission import Admission
+from ..procpool import FacetPool
 
 POLYS = dict()
+LOADED = LoadedFacets()
+WARMUP = Dict(secs=None, threads=0)
+RESULTS = TTLCache()
+JOBS = Jobs()
+ADMISSION = dict()
+RELOADING = Dict(lock=threading.Lock(), facets=dict())
+# each POLYS entry's version, so cached results never outlive a reload
+GENERATION = itertools.count(1)
 
-# pylint: disable=too-many-locals
-def initialize():
-    """module initialization--cache some things"""
-    base = "./polys"
+def initialize(conf):
+    """
+    Discover facets from their _polyform.json.  Unless conf.lazy is set they
+    are warmed now, conf.warm_threads at a time, and startup waits on them;
+    otherwise on first call, with at most conf.loaded_max kept imported at
+    once (0 is unbounded).
+    """
+    base = conf.base
     # just sugar
     def pjoin(*args):
         return os.path.join(*args)
 
-    cwd = os.getcwd()
     polys = list()
     for pname in os.listdir(base):
         if os.path.isdir(pjoin(base, pname)):
@@ -36,37 +60,348 @@ def initialize():
                     ))
 
     for poly in polys:
-        pname, fname = poly.name.split(".")
-        bpath = pjoin(cwd, poly.path)
-        path = pjoin(bpath, "_polyform.json")
-        with open(path) as conf:
-            pconf = json.load(conf)
-
-        os.chdir(pjoin(cwd, poly.path))
-        sys.path.append('.')
-        form = pconf['forms'][pconf['target']]
-        run = re.sub(r'[^a-z0-9_.]+', '', form['run'])
-        modexp = run.split(".")
-        modpath = ".".join(modexp[0:-1])
-        importlib.invalidate_caches()
-        mod = importlib.import_module(modpath)
-        sys.path = sys.path[:-1]
-        os.chdir(cwd)
-
-        POLYS[poly.name] = Dict(conf=pconf, mod=mod, path=bpath, run=modexp[-1])
-
-initialize()
+        POLYS[poly.name] = _facet(poly.name, poly.path)
+
+    for name, facet in POLYS.items():
+        admission = _admission(_form(facet))
+        if admission:
+            ADMISSION[name] = admission
+
+    if conf.lazy:
+        LOADED.limit = int(conf.loaded_max)
+    else:
+        WARMUP.threads = int(conf.warm_threads)
+        # isolated facets are imported by their workers, never here
+        WARMUP.secs = LOADED.warm([facet for facet in POLYS.values() if not facet.pool],
+                                  threads=WARMUP.threads)
+        print("warmed {} facets in {}s".format(len(POLYS), WARMUP.secs))
+
+def _form(facet):
+    """the facet's target form"""
+    return facet.conf['forms'][facet.conf['target']]
+
+# pylint: disable=too-many-locals
+def _facet(name, path):
+    """a POLYS entry, read from the facet's _polyform.json"""
+    bpath = os.path.abspath(path)
+    path = os.path.join(bpath, "_polyform.json")
+    mtime = os.stat(path).st_mtime
+    with open(path) as pconf_file:
+        pconf = json.load(pconf_file)
+
+    form = pconf['forms'][pconf['target']]
+    run = re.sub(r'[^a-z0-9_.]+', '', form['run'])
+    modexp = run.split(".")
+    # optional model-loading hook, in the same module as run
+    warm = re.sub(r'[^a-z0-9_]+', '', form.get('warm', '').split(".")[-1])
+
+    # optional batch entry point, also in the same module:
+    #   "batch": {"run": "main.handler_many", "size": 32, "window_ms": 5}
+    batch = form.get('batch')
+    batcher = None
+    if batch:
+        batch['run'] = re.sub(r'[^a-z0-9_]+', '', batch['run'].split(".")[-1])
+        batcher = Batcher(size=batch.get('size', 32),
+                          window=batch.get('window_ms', 5) / 1000)
+
+    modpath = ".".join(modexp[0:-1])
+    return Dict(name=name, conf=pconf, path=bpath, mtime=mtime,
+                generation=next(GENERATION),
+                modpath=modpath, run=modexp[-1],
+                warm=warm, mod=None, modules=[], stat=Dict(),
+                lock=threading.Lock(), batch=batch,
+                batcher=batcher, cache=_cache_conf(form),
+                ingest=_ingest_conf(form),
+                pool=_isolation(name, form, (bpath, modpath, warm)),
+                ctx=FacetContext(name, bpath, pconf))
+
+################################################################################
+def reload_facet(name):
+    """
+    Re-read one facet's _polyform.json, import its module afresh and warm
+    it (an isolated facet's new workers do that instead, as they start), then
+    swap it into POLYS.  Until the swap every call runs the old version;
+    calls already running when it happens finish on it.
+    """
+    old = POLYS[name]
+    new = _facet(name, old.path)
+    if not new.pool:
+        load_facet(new, replacing=old)
+
+    # the swap: everything below is cheap
+    POLYS[name] = new
+    LOADED.replace(old, new)
+    limits = _form(new).get('concurrency')
+    if limits != _form(old).get('concurrency'):
+        admission = _admission(_form(new))
+        if admission:
+            ADMISSION[name] = admission
+        else:
+            ADMISSION.pop(name, None)
+    # unreachable now (keys carry the generation); this frees them early
+    RESULTS.discard(lambda key: key[0] == name)
+    if old.pool:
+        old.pool.close()
+    elif new.pool:
+        # now isolated: its workers import it, so let this process's copy go
+        unload_facet(old)
+    return new
+
+def start_reload(name):
+    """reload a facet on a background thread; False if one is running already"""
+    with RELOADING.lock:
+        status = RELOADING.facets.get(name)
+        if status and status.finished is None:
+            return False
+        status = RELOADING.facets[name] = Dict(started=time.time(), finished=None,
+                                               status="loading", message=None)
+
+    def reload():
+        try:
+            new = reload_facet(name)
+            status.status = "done"
+            status.stat = dict(new.stat)
+        except Exception as err: # pylint: disable=broad-except
+            log("error", facet=name, traceback=json4store(traceback.format_exc()))
+            status.status = "failed"
+            status.message = str(err)
+        status.finished = time.time()
+        log("type=reload", facet=name, status=status.status,
+            secs=round(status.finished - status.started, 3))
+
+    threading.Thread(target=reload, name="reload-" + name, daemon=True).start()
+    return True
+
+def _watch():
+    """reload facets whose _polyform.json changed"""
+    for name, facet in list(POLYS.items()):
+        try:
+            mtime = os.stat(os.path.join(facet.path, "_polyform.json")).st_mtime
+        except OSError:
+            continue
+        if mtime != facet.mtime:
+            status = RELOADING.facets.get(name)
+            # don't retry a failed reload until the file changes again
+            if status and status.get('mtime') == mtime:
+                continue
+            if start_reload(name):
+                RELOADING.facets[name].mtime = mtime
+
+def _cache_conf(form):
+    """
+    result caching is opt-in per form: "cache": true, or {"ttl": seconds}
+    """
+    cache = form.get('cache')
+    if not cache:
+        return None
+    if not isinstance(cache, dict):
+        cache = dict()
+    return cache
+
+def _admission(form):
+    """
+    concurrency limits are opt-in per form:
+        "concurrency": {"limit": 4, "queue": 16, "timeout": 30, "retry_after": 1}
+    """
+    limits = form.get('concurrency')
+    if not limits:
+        return None
+    return Admission(limit=limits.get('limit', 1), queue=limits.get('queue', 0),
+                     timeout=limits.get('timeout', 30),
+                     retry_after=limits.get('retry_after', 1))
+
+def _ingest_conf(form):
+    """
+    streamed request bodies are opt-in per form:
+        "ingest": {"max_mb": 4096, "spool_mb": 64}
+    the facet then gets an iterator of NDJSON records as parsed_body
+    """
+    ingest = form.get('ingest')
+    if not ingest:
+        return None
+    if not isinstance(ingest, dict):
+        ingest = dict()
+    return Dict(max_bytes=int(ingest.get('max_mb', 1024) * 1048576),
+                spool_bytes=int(ingest.get('spool_mb', 0) * 1048576))
+
+def _ingest_tool():
+    """leave the body unread for facets that ingest it as a stream"""
+    request = cherrypy.serving.request
+    facet = POLYS.get(request.path_info.strip("/").split("/")[0])
+    if facet and facet.ingest:
+        request.process_request_body = False
+
+# ahead of json_in (priority 30), which would otherwise read the whole body
+cherrypy.tools.polyform_ingest = cherrypy.Tool('before_request_body', _ingest_tool,
+                                               priority=20)
+
+def _isolation(name, form, spec):
+    """
+    running in worker processes is opt-in per form:
+        "isolate": {"workers": 2, "max_requests": 1000, "max_rss_mb": 2048,
+                    "timeout": 300}
+    not with ingest: a request body stream can't be sent to a worker
+    """
+    isolate = form.get('isolate')
+    if not isolate:
+        return None
+    if form.get('ingest'):
+        raise ValueError("Facet {}: isolate can't be combined with ingest".format(name))
+    if not isinstance(isolate, dict):
+        isolate = dict()
+    return FacetPool(name, spec, workers=isolate.get('workers', 2),
+                     max_requests=isolate.get('max_requests', 0),
+                     max_rss_mb=isolate.get('max_rss_mb', 0),
+                     timeout=isolate.get('timeout', 300))
+
+def _entry(facet, attr):
+    """facet function attr: in-process, or in the facet's worker pool"""
+    if facet.pool:
+        def isolated(event, context):
+            return facet.pool.call(context, attr, event)
+        return isolated
+    return getattr(LOADED.module(facet), attr)
+
+def _finished(facet, admission, body, started, outcome):
+    """a call is over: give back its admission slot and body, and record it"""
+    labels = (('facet', facet.name),)
+    if admission:
+        admission.release()
+    if isinstance(body, RecordStream):
+        body.close()
+    METRICS.gauge('polyapi_facet_in_flight', labels, -1)
+    METRICS.observe('polyapi_facet_seconds', labels, time.time() - started)
+    METRICS.count('polyapi_facet_calls_total', labels + (('outcome', outcome),))
+
+class Streamed():
+    """
+    A facet's streamed result.  The facet runs as it is read, so the call
+    only ends (finished() is called) once it is exhausted, fails or is
+    closed; each chunk is made under the facet's profiler tag and its CPU
+    and wall time count as the facet's, and as its trace span.
+    """
+
+    def __init__(self, facet, chunks, finished):
+        self.facet = facet
+        self.chunks = chunks
+        self.finished = finished
+        self.trace = tracing.current()
+        self.cpu = 0.0
+        self.wall = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished is None:
+            raise StopIteration
+        prev = profiler.tag(self.facet.name)
+        cpu = time.thread_time()
+        wall = time.time()
+        outcome = None
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            outcome = "streamed"
+            raise
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.cpu += time.thread_time() - cpu
+            self.wall += time.time() - wall
+            profiler.untag(prev)
+            if outcome:
+                self._finish(outcome)
+
+    def close(self):
+        """the reader is done with it, at the end or not"""
+        if self.finished is None:
+            return
+        try:
+            close = getattr(self.chunks, 'close', None)
+            if close:
+                close()
+        finally:
+            self._finish("aborted")
+
+    # a response dropped without being read or closed still ends the call
+    __del__ = close
+
+    def _finish(self, outcome):
+        """end the call, once"""
+        finished, self.finished = self.finished, None
+        if finished is None:
+            return
+        labels = (('facet', self.facet.name),)
+        METRICS.count('polyapi_facet_cpu_seconds_total', labels, self.cpu)
+        METRICS.count('polyapi_facet_wall_seconds_total', labels, self.wall)
+        if self.trace:
+            self.trace.add('facet', self.wall)
+        finished(outcome)
 
 # TODO: actually key this off of the config polyform.forms[form].run
 class Handler(Endpoint, Rest):
     """docstring"""
+    _cp_config = {'tools.polyform_ingest.on': True}
 
-    def rest_read(self, facet_path, *_args, **_kwargs):
-        """read"""
-        raise ValueError("HTTP GET is not a supported method")
+    def __init__(self, server=None, **kwargs):
+        super().__init__(server=server, **kwargs)
+        RESULTS.ttl = server.conf.cache.results.ttl
+        RESULTS.max_size = int(server.conf.cache.results.max_mb * 1048576)
+        JOBS.workers = int(server.conf.jobs.workers)
+        JOBS.queue = int(server.conf.jobs.queue)
+        JOBS.ttl = server.conf.jobs.ttl
+        JOBS.spool = server.conf.jobs.spool or None
+        if JOBS.spool:
+            os.makedirs(JOBS.spool, exist_ok=True)
+        cherrypy.engine.subscribe('stop', JOBS.stop)
+        initialize(server.conf.polyform)
+        if server.conf.polyform.watch:
+            # runs with the engine, so each pre-forked worker watches for itself
+            cherrypy.process.plugins.Monitor(cherrypy.engine, _watch,
+                                             frequency=server.conf.polyform.watch,
+                                             name="polyform-watch").subscribe()
 
-    def rest_create(self, facet_path, *_args, **_kwargs):
-        """call a polyform"""
+    def housekeeper(self, _server):
+        """expire cached results and collected-or-abandoned jobs"""
+        super().housekeeper(_server)
+        RESULTS.prune()
+        JOBS.prune()
+
+    def health_detail(self):
+        """warm-up timings for /health?detail=true"""
+        return {
+            'warmup': dict(WARMUP),
+            'cache': RESULTS.stats(),
+            'artifacts': artifacts.stats(),
+            'admission': {name: adm.stats() for name, adm in ADMISSION.items()},
+            'pools': {name: facet.pool.stats() for name, facet in POLYS.items()
+                      if facet.pool},
+            'reloads': {name: dict(status) for name, status in RELOADING.facets.items()},
+            'facets': {name: dict(facet.stat) for name, facet in POLYS.items()
+                       if facet.mod is not None},
+            'available': sorted(POLYS)
+        }
+
+    def rest_read(self, facet_path, *args, **_kwargs):
+        """GET jobs/<id>: status of a background call, with its result once done"""
+        if facet_path != "jobs" or len(args) != 1:
+            raise ValueError("HTTP GET is only supported for jobs/<id>")
+        lambda_auth(self)
+
+        job = JOBS.get(args[0])
+        if not job:
+            raise exceptions.ServerError("No such job (or it has expired)", 404)
+        status = {"job": job.id, "facet": job.name, "state": job.status,
+                  "created": job.created, "started": job.started,
+                  "finished": job.finished}
+        if job.finished is None:
+            return self.respond(status, status=202)
+        return self.respond(dict(job.result, job=status))
+
+    def rest_create(self, facet_path, *_args, **kwargs):
+        """call a polyform; with async=true, as a background job"""
         lambda_auth(self) # update so claims has polyform name in it
 
         facet = POLYS.get(facet_path)
@@ -74,12 +409,110 @@ class Handler(Endpoint, Rest):
             print("Cannot find polyform facet: {}, polyform: {}".format(facet_path, POLYS))
             raise exceptions.InvalidParameter("Cannot find polyform facet: {}".format(facet_path))
 
-        os.chdir(facet.path)
+        if kwargs.get('async') == "true":
+            if not JOBS.spool and int(self.server.conf.server.workers) > 1:
+                # a poll may land on any worker; only the spool is shared
+                raise ValueError("Jobs need jobs.spool set when running more than one worker")
+            if facet.ingest and not facet.ingest.spool_bytes:
+                raise ValueError("This facet streams its input; it can't run as a job")
+            body = self._body(facet)
+            job = JOBS.submit(facet.name, self._job, facet, body)
+            cherrypy.response.headers['Location'] = "{}/jobs/{}".format(
+                cherrypy.request.script_name, job.id)
+            return self.respond({"status": "accepted", "job": job.id}, status=202)
+
+        return self._run(facet, self._body(facet))
+
+    # pylint: disable=no-self-use
+    def _body(self, facet):
+        """the decoded request body, or a record stream for ingesting facets"""
+        if facet.ingest:
+            return RecordStream(cherrypy.request.rfile, facet.ingest.max_bytes,
+                                facet.ingest.spool_bytes)
+        return cherrypy.request.json
+
+    def _job(self, facet, body):
+        """a background call: streamed results are collected"""
+        try:
+            result = self._run(facet, body)
+            if is_stream(result):
+                result = {"status": "success", "data": list(result)}
+            return result
+        finally:
+            # the result is materialised: nothing reads the body now
+            if isinstance(body, RecordStream):
+                body.close()
+
+    def _run(self, facet, body):
+        """
+        call with metrics: cache hits skip admission, and the time spent
+        queued for admission is kept apart from execution time
+        """
+        labels = (('facet', facet.name),)
+        METRICS.gauge('polyapi_facet_in_flight', labels, 1)
+        prev = profiler.tag(facet.name)
+        started = time.time()
+        outcome = "error"
+        admission = ADMISSION.get(facet.name)
+        admitted = False
+        try:
+            key = None
+            if facet.cache:
+                key = body_key(body)
+                if key:
+                    key = (facet.name, facet.generation, key)
+                    cached = RESULTS.get(key)
+                    if cached is not None:
+                        outcome = "cached"
+                        return cached
+
+            if admission:
+                try:
+                    waited = admission.acquire()
+                except exceptions.Overloaded:
+                    outcome = "rejected"
+                    raise
+                admitted = True
+                METRICS.observe('polyapi_facet_queue_seconds', labels, waited)
+                tracing.add('queue', waited)
+                started = time.time()
+
+            result, called = self._call(facet, body, key)
+            if called == "streamed":
+                # the facet runs as the result is read: the call ends with it
+                result = Streamed(facet, result, functools.partial(
+                    _finished, facet, admission if admitted else None, body, started))
+            outcome = called
+            return result
+        finally:
+            profiler.untag(prev)
+            if outcome != "streamed":
+                _finished(facet, admission if admitted else None, body, started, outcome)
 
-        result = getattr(facet.mod, facet.run)(
-            dict(headers={}, parsed_body=cherrypy.request.json),
-            {}
-        )
+    # pylint: disable=no-self-use
+    def _call(self, facet, body, key):
+        """run the facet, caching under key if given; returns (result, outcome)"""
+        # facets resolve their files through facet.ctx, never the process cwd
+        event = dict(headers={}, parsed_body=body)
+        cpu = time.thread_time()
+        wall = time.time()
+        with tracing.span('facet'):
+            if facet.batcher:
+                result = facet.batcher.call(_entry(facet, facet.batch['run']),
+                                            event, facet.ctx)
+            else:
+                result = _entry(facet, facet.run)(event, facet.ctx)
+        # how CPU bound facets are, for sizing the thread pool
+        labels = (('facet', facet.name),)
+        METRICS.count('polyapi_facet_cpu_seconds_total', labels, time.thread_time() - cpu)
+        METRICS.count('polyapi_facet_wall_seconds_total', labels, time.time() - wall)
+        if is_stream(result):
+            # chunks are encoded and sent as the facet yields them
+            return result, "streamed"
         if not result.get('status'):
             result['status'] = "success"
-        return result
+        if key and result['status'] == "success":
+            # the cached dict is handed out as-is; nothing downstream mutates it
+            RESULTS.set(key, result, size=len(json4store(result)),
+                        ttl=facet.cache.get('ttl'))
+        return result, "success" if result['status'] == "success" else "failed"
@@ -38,3 +38,9 @@ class InvalidParameter(Exception):
 
 class ServerError(Exception):
     """Return an HTTP Error"""
+
+class Overloaded(Exception):
+    """Refused for lack of capacity: args are (message, status, retry after)"""
+
+class Unreachable(ConnectionError):
+    """A backend could not be connected to, so nothing was sent to it"""
@@ -0,0 +1,225 @@
+"""
+Facet execution context and loading
+"""
+
+import os
+import sys
+import time
+import threading
+import importlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from dictlib import Dict
+from .util import rss_mb
+from . import artifacts
+
+# sys.path and sys.modules are process-global, so facet imports are serialized
+IMPORT_LOCK = threading.RLock()
+
+################################################################################
+class FacetContext():
+    """
+    Lambda-style context handed to a facet's run function.
+
+    Carries the facet's resolved base directory, so a facet can find its
+    model files without relying on (or changing) the process working
+    directory, which is shared by every CherryPy worker thread.
+    """
+    name = None
+    function_name = None
+    path = None
+    conf = None
+
+    def __init__(self, name, path, conf):
+        self.name = name
+        self.function_name = name
+        self.path = os.path.abspath(path)
+        self.conf = conf
+
+    def resolve(self, *parts):
+        """absolute path to a file within this facet"""
+        return os.path.join(self.path, *parts)
+
+    def open(self, relpath, mode='r', **kwargs):
+        """open a file relative to the facet directory"""
+        return open(self.resolve(relpath), mode, **kwargs)
+
+    def load_artifact(self, relpath):
+        """
+        a model file within this facet, memory-mapped read-only and shared
+        with other processes on the host (see artifacts.load)
+        """
+        return artifacts.load(self.resolve(relpath))
+
+    def __repr__(self):
+        return "<FacetContext {} {}>".format(self.name, self.path)
+
+################################################################################
+def _within(mod, path):
+    """is this module loaded from a file under path?"""
+    fname = getattr(mod, '__file__', None)
+    if not fname:
+        return False
+    return os.path.abspath(fname).startswith(path + os.sep)
+
+def _drop_bytecode(mod):
+    """
+    remove a module's cached bytecode, which is only checked against the
+    source's mtime (to the second) and size: a quick or mtime-preserving
+    deploy could otherwise re-import the old code
+    """
+    cached = getattr(mod, '__cached__', None)
+    if cached:
+        try:
+            os.remove(cached)
+        except OSError:
+            pass
+
+def load_facet(facet, replacing=None):
+    """
+    Import a facet's module with its directory on sys.path, then run its
+    warm hook (model loading) if the form declares one.
+
+    Remembers which sys.modules entries came from the facet directory, so it
+    can be unloaded later without disturbing shared libraries (pandas et al).
+    The import itself is serialized; warm hooks of different facets run in
+    parallel.  Timings land in facet.stat.
+
+    When replacing an older entry for the same facet, its modules are taken
+    out of sys.modules so they are imported afresh from disk; the old entry
+    keeps its module object (and its calls in flight keep working).  They go
+    back if the new import or its warm hook fails, and the new modules go.
+    """
+    with facet.lock:
+        if facet.mod is not None:
+            return facet.mod
+        rss = rss_mb()
+        started = time.time()
+        with IMPORT_LOCK:
+            locked = time.time()
+            stale = dict()
+            if replacing is not None:
+                for name in replacing.modules or []:
+                    if name in sys.modules:
+                        stale[name] = sys.modules.pop(name)
+                        _drop_bytecode(stale[name])
+                replacing.modules = []
+            before = set(sys.modules)
+            sys.path.append(facet.path)
+            try:
+                importlib.invalidate_caches()
+                mod = importlib.import_module(facet.modpath)
+            except BaseException:
+                _undo(facet, before, stale, replacing)
+                raise
+            finally:
+                sys.path.remove(facet.path)
+            facet.modules = [name for name in set(sys.modules) - before
+                             if _within(sys.modules[name], facet.path)]
+        imported = time.time()
+
+        if facet.warm:
+            try:
+                getattr(mod, facet.warm)(facet.ctx)
+            except BaseException:
+                with IMPORT_LOCK:
+                    _undo(facet, before, stale, replacing)
+                raise
+        warmed = time.time()
+
+        facet.stat = Dict(import_wait=round(locked - started, 3),
+                          import_secs=round(imported - locked, 3),
+                          model_secs=round(warmed - imported, 3),
+                          rss_delta_mb=round(rss_mb() - rss, 1),
+                          loaded_at=round(warmed, 3))
+        facet.mod = mod
+    return mod
+
+def _undo(facet, before, stale, replacing):
+    """
+    a load failed: forget the modules it imported from the facet directory
+    and put back the ones it took from the entry it was replacing
+    """
+    for name in set(sys.modules) - before:
+        if _within(sys.modules[name], facet.path):
+            sys.modules.pop(name)
+    facet.modules = []
+    sys.modules.update(stale)
+    if replacing is not None:
+        replacing.modules = list(stale)
+
+def unload_facet(facet):
+    """drop a facet's modules so their memory can be reclaimed"""
+    with facet.lock, IMPORT_LOCK:
+        for name in facet.modules or []:
+            sys.modules.pop(name, None)
+        facet.modules = []
+        facet.mod = None
+
+################################################################################
+class LoadedFacets():
+    """
+    LRU of facets with their modules imported, keyed on the POLYS name.
+
+    A limit of zero never evicts.  Callers get the run function itself, so a
+    request already in flight keeps working if its facet is evicted.
+    """
+    limit = 0
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.order = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def use(self, facet, attr=None):
+        """make sure the facet is loaded; return its run (or attr) function"""
+        return getattr(self.module(facet), attr or facet.run)
+
+    def module(self, facet):
+        """make sure the facet is loaded; return its module"""
+        mod = facet.mod
+        if mod is not None:
+            with self.lock:
+                if facet.name in self.order:
+                    self.order.move_to_end(facet.name)
+            return mod
+
+        mod = load_facet(facet)
+        evicted = []
+        with self.lock:
+            self.order[facet.name] = facet
+            self.order.move_to_end(facet.name)
+            while self.limit and len(self.order) > self.limit:
+                _, old = self.order.popitem(last=False)
+                evicted.append(old)
+        for old in evicted:
+            unload_facet(old)
+        return mod
+
+    def replace(self, old, new):
+        """
+        Swap a reloaded entry in for the old one, which was relieved of its
+        modules by load_facet(new, replacing=old).
+        """
+        with self.lock:
+            self.order.pop(old.name, None)
+            if new.mod is not None:
+                self.order[new.name] = new
+
+    def warm(self, facets, threads=4):
+        """
+        Load facets on a thread pool, blocking until every one is warm.
+        Returns the wall time; a facet that fails to load fails startup.
+        rss_delta_mb is approximate when facets warm concurrently.
+        """
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, threads),
+                                thread_name_prefix='warm') as pool:
+            for future in [pool.submit(self.use, facet) for facet in facets]:
+                future.result()
+        return round(time.time() - started, 3)
+
+    def names(self):
+        """currently loaded facets, least recently used first"""
+        with self.lock:
+            return list(self.order)
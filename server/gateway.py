@@ -0,0 +1,240 @@
+"""
+Routing facet calls across polyapi nodes
+"""
+
+import time
+import queue
+import bisect
+import hashlib
+import threading
+import http.client
+import urllib.parse
+from . import exceptions
+from .util import json2data
+from .logger import log
+
+################################################################################
+# pylint: disable=too-many-instance-attributes
+class Backend():
+    """
+    One polyapi node: which facets it has (and has warm), whether its
+    /health answers, and a pool of keep-alive connections to it.  New
+    connections get connect_timeout to be made, calls then get timeout.
+    """
+
+    def __init__(self, url, pool=8, timeout=30, connect_timeout=2):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url.rstrip("/")
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.base = parsed.path.rstrip("/") or "/api/v1"
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.idle = queue.LifoQueue(maxsize=pool)
+        self.healthy = False
+        self.warm = frozenset()
+        self.available = frozenset()
+        self.in_flight = 0
+        self.failures = 0
+        self.checked = None
+
+    def _conn(self):
+        """
+        an idle connection and whether it was reused; a new one is connected
+        here, raising exceptions.Unreachable if that fails or times out
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            pass
+        conn = http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except OSError as err:
+            conn.close()
+            raise exceptions.Unreachable("{}: {}".format(self.url, err)) from err
+        conn.timeout = self.timeout
+        conn.sock.settimeout(self.timeout)
+        return conn, False
+
+    def release(self, conn, response):
+        """back to the pool, unless either side is closing it"""
+        if response.will_close:
+            conn.close()
+            return
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        (connection, response); the body is still to be read and the
+        connection then handed back with release().  A reused connection the
+        node has since closed is retried once on a fresh one; otherwise a
+        connection error is raised as is (Unreachable when nothing was sent).
+        """
+        while True:
+            conn, reused = self._conn()
+            try:
+                conn.request(method, self.base + path, body, headers or {})
+                return conn, conn.getresponse()
+            except TimeoutError:
+                # the call may well be running: never send it again
+                conn.close()
+                raise
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+
+    def check(self, timeout=2):
+        """
+        ask the node's /health?detail=true what it has, on a connection of
+        its own with a short timeout (a probe, not a call)
+        """
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            try:
+                conn.request('GET', self.base + "/health?detail=true")
+                response = conn.getresponse()
+                body = response.read()
+            finally:
+                conn.close()
+            if response.status not in (200, 204):
+                raise exceptions.ServerError("health {}".format(response.status), 502)
+            detail = (json2data(body) if body else {}).get('polyform', {})
+            self.warm = frozenset(detail.get('facets', {}))
+            self.available = frozenset(detail.get('available', self.warm))
+            if not self.healthy:
+                log("type=gateway", backend=self.url, healthy=True,
+                    facets=len(self.available))
+            self.healthy = True
+            self.failures = 0
+        except (OSError, ValueError, http.client.HTTPException,
+                exceptions.ServerError) as err:
+            self.failed(err)
+        self.checked = time.time()
+
+    def failed(self, err):
+        """stop routing here until the next good health check"""
+        self.failures += 1
+        if self.healthy:
+            log("type=gateway", backend=self.url, healthy=False, error=str(err))
+        self.healthy = False
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        """for /health?detail=true"""
+        return dict(healthy=self.healthy, in_flight=self.in_flight,
+                    failures=self.failures, warm=len(self.warm),
+                    available=len(self.available), checked=self.checked)
+
+################################################################################
+def _hash(key):
+    """a point on the ring"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+# pylint: disable=too-few-public-methods
+class Ring():
+    """consistent hash ring of backends, vnodes points each"""
+
+    def __init__(self, backends, vnodes=64):
+        points = sorted((_hash("{}#{}".format(backend.url, num)), idx)
+                        for idx, backend in enumerate(backends)
+                        for num in range(vnodes))
+        self.keys = [point for point, _ in points]
+        self.owners = [idx for _, idx in points]
+        self.backends = backends
+
+    def order(self, key):
+        """every backend, in ring order from key"""
+        seen = []
+        start = bisect.bisect(self.keys, _hash(key))
+        for offset in range(len(self.keys)):
+            idx = self.owners[(start + offset) % len(self.keys)]
+            if idx not in seen:
+                seen.append(idx)
+                if len(seen) == len(self.backends):
+                    break
+        return [self.backends[idx] for idx in seen]
+
+class Gateway():
+    """
+    Picks the backend for a facet call.  Each facet hashes to a stable run
+    of nodes on the ring, so it stays warm in the same few places; the
+    first `spread` healthy nodes with the facet warm are candidates and the
+    one with the fewest calls in flight from here wins.  Nodes where it is
+    available but not yet warm are only used when no node has it warm.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, urls, spread=2, vnodes=64, pool=8, timeout=30,
+                 connect_timeout=2, probe_timeout=2):
+        self.backends = [Backend(url, pool=pool, timeout=timeout,
+                                 connect_timeout=connect_timeout) for url in urls]
+        self.ring = Ring(self.backends, vnodes=vnodes)
+        self.spread = max(1, spread)
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+
+    def check(self):
+        """health-check every backend at once, so a hung one holds up no other"""
+        threads = [threading.Thread(target=backend.check, args=(self.probe_timeout,),
+                                    name="gateway-check", daemon=True)
+                   for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def choose(self, facet):
+        """candidate backends for a facet, best first"""
+        order = [backend for backend in self.ring.order(facet) if backend.healthy]
+        warm = [backend for backend in order if facet in backend.warm]
+        if not warm:
+            warm = [backend for backend in order if facet in backend.available]
+        near = sorted(warm[:self.spread], key=lambda backend: backend.in_flight)
+        return near + warm[self.spread:]
+
+    def forward(self, backends, method, path, body, headers):
+        """
+        Send the call to the first backend that takes it, failing over only
+        when a node can't be connected to: once the call is sent it may be
+        running, so a timeout or a dropped connection after that is an error
+        (504, 502), never a retry elsewhere.  Returns (backend, connection,
+        response), with the backend's in_flight count raised until done() is
+        called.
+        """
+        for backend in backends:
+            with self.lock:
+                backend.in_flight += 1
+            try:
+                conn, response = backend.request(method, path, body, headers)
+                return backend, conn, response
+            except exceptions.Unreachable as err:
+                self.done(backend)
+                backend.failed(err)
+            except TimeoutError as err:
+                # sent, so it may well be running: never send it again
+                self.done(backend)
+                raise exceptions.ServerError("Backend timed out", 504) from err
+            except (OSError, http.client.HTTPException) as err:
+                self.done(backend)
+                backend.failed(err)
+                raise exceptions.ServerError("Backend connection failed", 502) from err
+        raise exceptions.ServerError("No backend available", 502)
+
+    def done(self, backend):
+        """a forwarded call has finished"""
+        with self.lock:
+            backend.in_flight -= 1
+
+    def stats(self):
+        """for /health?detail=true"""
+        return {backend.url: backend.stats() for backend in self.backends}
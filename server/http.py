@@ -8,23 +8,39 @@ Endpoints for Polyform API
 """
 
 import time
+import hmac
 import traceback
-import random
 import cherrypy
 import polyform
-from . import exceptions
-from .util import json4store
+from . import exceptions, profiler, tracing, load
+from .cache import TTLCache
+from .throttle import AuthThrottle
+from .metrics import METRICS
+from .util import json4store, json4wire, get_jwt_payload, get_jti, remote_addr
+from .columnar import BODY_TYPES, body_processor, body_handler
 from .logger import set_DEBUG, log
 
 
-################################################################################
-# random id
-def uniqueid():
-    """generate a unique id"""
-    seed = random.getrandbits(32)
-    while True:
-        yield "%x" % seed
-        seed += 1
+# clients that keep failing auth are refused at the door (tools.auth_throttle)
+THROTTLE = AuthThrottle()
+
+def _throttle_tool():
+    """refuse a blocked client before its body is read: 429 with Retry-After"""
+    wait = THROTTLE.retry_after(remote_addr())
+    if not wait:
+        return
+    request = cherrypy.serving.request
+    request.process_request_body = False
+    request.handler = None
+    response = cherrypy.serving.response
+    response.status = 429
+    response.headers['Retry-After'] = str(wait)
+    response.headers['Content-Type'] = 'application/json'
+    response.body = json4wire({"status": "failed", "message": "Too Many Requests"})
+
+# ahead of the body tools (polyform_ingest at 20, json_in at 30)
+cherrypy.tools.auth_throttle = cherrypy.Tool('before_request_body', _throttle_tool,
+                                             priority=10)
 
 ###############################################################################
 # add object because BaseHTTPRequestHandler is an old style class
@@ -41,8 +57,6 @@ class Rest():
     exposed = True
     json_body = None
     allowed = {}
-    reqgen = uniqueid()
-    reqid = 0
 
     ###########################################################################
     #def __init__(self, *args, **kwargs):
@@ -52,7 +66,7 @@ class Rest():
     def respond_failure(self, message, status=400):
         """Respond with a failure"""
         if status == 401:
-            time.sleep(5) # Future: could add to memcache and increase logarithmically?
+            THROTTLE.failed(remote_addr())
         if not message:
             raise exceptions.ServerError("Failure", status)
         raise exceptions.ServerError(message, status)
@@ -68,11 +82,30 @@ class Rest():
         return content
 
     ###########################################################################
-    # pylint: disable=invalid-name,too-many-branches
     def _rest_crud(self, method, *args, **kwargs):
         """Called by the relevant method when content should be posted"""
-        #cherrypy.serving.request.reqid =
-        self.reqid = next(self.reqgen)
+        labels = (('route', cherrypy.request.script_name),)
+        METRICS.gauge('polyapi_requests_in_flight', labels, 1)
+        prev = profiler.tag(cherrypy.request.script_name)
+        started = time.time()
+        status = 500
+        try:
+            result = self._rest_call(method, *args, **kwargs)
+            status = cherrypy.response.status or 200
+            return result
+        finally:
+            profiler.untag(prev)
+            METRICS.gauge('polyapi_requests_in_flight', labels, -1)
+            labels += (('method', cherrypy.request.method),)
+            METRICS.observe('polyapi_request_seconds', labels, time.time() - started)
+            METRICS.count('polyapi_requests_total',
+                          labels + (('status', str(status).split(" ")[0]),))
+
+    ###########################################################################
+    # pylint: disable=invalid-name,too-many-branches
+    def _rest_call(self, method, *args, **kwargs):
+        """auth throttling and error handling around the rest_* method"""
+        client = remote_addr()
         do_abac_log = False
         if kwargs.get('abac') == "log":
             if set_DEBUG('abac', True):
@@ -81,9 +114,15 @@ class Rest():
             return getattr(self, method)(*args, **kwargs)
         except exceptions.AuthFailed as err:
             log("authfail", reason=str(err)) # err.args[1])
+            THROTTLE.failed(client)
             cherrypy.response.status = 401
             return {"status": "failed", "message": "Unauthorized"}
 
+        except exceptions.Overloaded as err:
+            cherrypy.response.status = err.args[1]
+            cherrypy.response.headers['Retry-After'] = str(err.args[2])
+            return {"status": "failed", "message": err.args[0]}
+
         except (ValueError,
                 exceptions.InvalidParameter,
                 exceptions.ServerError,
@@ -110,31 +149,31 @@ class Rest():
     ###########################################################################
     # could decorate these, but .. this is shorter code
     #@cherrypy.tools.accept(media='application/json')
-    @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in(content_type=BODY_TYPES, processor=body_processor)
+    @cherrypy.tools.json_out(handler=body_handler)
     def POST(self, *args, **kwargs):
         """Wrapper for REST calls"""
         return self._rest_crud('rest_create', *args, **kwargs)
 
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=body_handler)
     def GET(self, *args, **kwargs):
         """Wrapper for REST calls"""
         return self._rest_crud('rest_read', *args, **kwargs)
 
     #@cherrypy.tools.accept(media='application/json')
-    @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in(content_type=BODY_TYPES, processor=body_processor)
+    @cherrypy.tools.json_out(handler=body_handler)
     def PUT(self, *args, **kwargs):
         """Wrapper for REST calls"""
         return self._rest_crud('rest_update', *args, **kwargs)
 
-    @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in(content_type=BODY_TYPES, processor=body_processor)
+    @cherrypy.tools.json_out(handler=body_handler)
     def PATCH(self, *args, **kwargs):
         """Wrapper for REST calls""" # not working w/CherryPY and json
         return self._rest_crud('rest_patch', *args, **kwargs)
 
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=body_handler)
     def DELETE(self, *args, **kwargs):
         """Wrapper for REST calls"""
         return self._rest_crud('rest_delete', *args, **kwargs)
@@ -152,10 +191,18 @@ class Endpoint():
     def __init__(self, server=None, **_kwargs):
         self.server = server
 
-    def housekeeper(self, server):
+    def housekeeper(self, _server):
         """
         Run periodically to do any cleanup, garbage collection, etc
         """
+        AUTH_CACHE.prune()
+        THROTTLE.prune()
+
+    def health_detail(self):
+        """
+        Extra information for /health?detail=true, keyed by endpoint name
+        """
+        return {}
 
 # pylint: disable=wrong-import-position,wrong-import-order
 from polyform.sls.reflex_arc import lambda_proxy_auth, AuthFailed
@@ -176,13 +223,78 @@ def endpoint_authorized(func): # *args, **kwargs):
         return func(*args, **kwargs)
     return authorized_decorator
 
+# verified tokens: jti -> (token, auth result)
+AUTH_CACHE = TTLCache(max_size=10000)
+
+def bearer_token(headers):
+    """the bearer token from an Authorization header, if any"""
+    auth = headers.get('Authorization', '')
+    if auth[:7].lower() == "bearer ":
+        return auth[7:].strip()
+    return None
+
 def lambda_auth(master):
-    """wrap lambda auth proxy"""
+    """
+    wrap lambda auth proxy.
+
+    A bearer token which verified is remembered by its jti until the earlier
+    of its own expiry and auth.expires, so repeat callers cost a lookup.  The
+    whole token must match the remembered one; the jti is only the key.
+    """
+    with tracing.span('auth'):
+        return _lambda_auth(master)
+
+def admin_auth(master):
+    """
+    lambda_auth for operational routes: the bearer token must also grant
+    auth.admin_scope in its scope (or scp) claim, or it is refused (403)
+    """
+    result = lambda_auth(master)
+    scope = master.server.conf.auth.admin_scope
+    token = bearer_token(master.server.cherry.request.headers)
     try:
-        return lambda_proxy_auth({"headers": master.server.cherry.request.headers}, {})
+        claims = get_jwt_payload(token) if token else {}
+        granted = claims.get('scope', claims.get('scp', ''))
+    except (ValueError, IndexError, AttributeError):
+        granted = ''
+    if isinstance(granted, str):
+        granted = granted.split()
+    if not scope or scope not in granted:
+        raise exceptions.ServerError("Forbidden", 403)
+    return result
+
+def _lambda_auth(master):
+    """lambda_auth, untimed"""
+    headers = master.server.cherry.request.headers
+    token = bearer_token(headers)
+    jti = None
+    if token:
+        try:
+            jti = get_jti(token)
+        except (ValueError, IndexError, AttributeError):
+            jti = None
+        if jti:
+            cached = AUTH_CACHE.get(jti)
+            # as bytes: compare_digest refuses non-ASCII str, and cheroot
+            # decodes headers as latin-1
+            if cached and hmac.compare_digest(cached[0].encode('latin-1'),
+                                              token.encode('latin-1')):
+                return cached[1]
+
+    try:
+        result = lambda_proxy_auth({"headers": headers}, {})
     except AuthFailed as err:
         raise exceptions.AuthFailed(str(err))
 
+    if jti:
+        ttl = master.server.conf.auth.expires
+        expires = get_jwt_payload(token).get('exp')
+        if isinstance(expires, (int, float)):
+            ttl = min(ttl, expires - time.time())
+        if ttl > 0:
+            AUTH_CACHE.set(jti, (token, result), ttl=ttl)
+    return result
+
 ################################################################################
 class Health(Rest, Endpoint):
     """
@@ -202,6 +314,10 @@ class Health(Rest, Endpoint):
         if kwargs.get('detail') == 'true':
             detail['last-heartbeat'] = 0
             detail['version'] = self.server.conf.deploy_ver
+            for endpoint in self.server.endpoints:
+                extra = endpoint.handler.health_detail()
+                if extra:
+                    detail[endpoint.name] = extra
 
         if stat.heartbeat.last:
             if stat.heartbeat.last + self.server.conf.heartbeat < time.time():
@@ -217,3 +333,71 @@ class Health(Rest, Endpoint):
             return self.respond_failure(detail, status=503)
 
         return self.respond(detail)
+
+################################################################################
+class Ready(Rest, Endpoint):
+    """
+    Readiness, for load balancers: unlike /health (liveness), this fails
+    when the node is saturated, and reports a weight to send it less
+    traffic as it gets busy.
+    """
+    recent = None
+
+    def __init__(self, server=None, **kwargs):
+        super().__init__(server=server, **kwargs)
+        base = server.conf.server.route_base
+        self.recent = load.Recent(window=server.conf.ready.window,
+                                  exclude=(base + "/ready", base + "/health"))
+
+    # pylint: disable=unused-argument
+    def rest_read(self, *args, **kwargs):
+        """
+        Saturation is the worst of: the fraction of worker threads busy (of
+        the most the pool may grow to, when it is adaptive), connections
+        queued per worker thread, and recent p95 over max_p95_ms.
+        Weight is 100 when idle down to 0 when saturated; past max_saturation
+        the node answers 503 (not ready).
+        """
+        conf = self.server.conf.ready
+        workers = load.workers()
+        threads = workers['threads'] or 1
+        capacity = max(workers['max'] or 0, threads)
+        queued = load.accept_queue(self.server.conf.server.port)
+        p95 = load.quantile(self.recent.histogram(), 0.95)
+
+        pressure = {
+            'busy': (workers['busy'] - 1) / capacity, # not counting this request
+            'queued': (workers['queued'] + (queued or 0)) / threads
+        }
+        if conf.max_p95_ms and p95 is not None:
+            pressure['p95'] = p95 * 1000 / conf.max_p95_ms
+        saturation = max(pressure.values())
+        ready = saturation < conf.max_saturation
+
+        weight = max(0, int(round(100 * (1 - saturation))))
+        cherrypy.response.headers['X-Weight'] = str(weight)
+        status = {
+            'ready': ready,
+            'weight': weight,
+            'saturation': round(saturation, 3),
+            'workers': workers,
+            'accept_queue': queued,
+            'p95_ms': None if p95 is None else p95 * 1000,
+            'facets_in_flight': load.in_flight()
+        }
+        if not ready:
+            return self.respond_failure(status, status=503)
+        return self.respond(status)
+
+################################################################################
+class Metrics(Endpoint):
+    """
+    Request and facet metrics in text exposition format
+    """
+    exposed = True
+
+    # pylint: disable=invalid-name,unused-argument
+    def GET(self, *args, **kwargs):
+        """scrape"""
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return METRICS.render()
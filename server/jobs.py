@@ -0,0 +1,180 @@
+"""
+Background jobs for long-running facet calls
+"""
+
+import os
+import re
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dictlib import Dict
+from . import exceptions
+from .util import json4store, json2data
+from .logger import log
+
+JOB_ID = re.compile(r'[0-9a-f]{32}')
+
+################################################################################
+# pylint: disable=too-many-instance-attributes
+class Jobs():
+    """
+    Facet calls run off the request thread.  At most `workers` run at once and
+    at most `queue` more wait; past that submit() refuses with a 503.  A
+    finished job is kept `ttl` seconds for its client to collect, then
+    pruned by the housekeeper.
+
+    The pool is only created on first use, so pre-forked workers don't
+    inherit its threads.  Jobs live in the process that runs them; with a
+    `spool` directory each is also written there as it changes, so any
+    pre-forked worker can answer for it.
+    """
+    workers = 4
+    queue = 64
+    ttl = 3600
+    spool = None
+
+    def __init__(self, workers=4, queue=64, ttl=3600, spool=None):
+        self.workers = workers
+        self.queue = queue
+        self.ttl = ttl
+        self.spool = spool
+        self.pool = None
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        self.waiting = 0
+
+    def submit(self, name, func, *args):
+        """queue func(*args), returning the job"""
+        with self.lock:
+            if self.waiting >= self.workers + self.queue:
+                raise exceptions.ServerError("Too many jobs queued, try again later", 503)
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='job')
+            job = Dict(id=uuid.uuid4().hex, name=name, status="queued",
+                       created=time.time(), started=None, finished=None,
+                       result=None, expires=None, pid=os.getpid())
+            self.jobs[job.id] = job
+            self.waiting += 1
+        self._save(job)
+        self.pool.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        """worker side"""
+        job.started = time.time()
+        job.status = "running"
+        self._save(job)
+        try:
+            job.result = func(*args)
+            job.status = "done"
+        except Exception as err: # pylint: disable=broad-except
+            log("error", job=job.id, traceback=json4store(traceback.format_exc()))
+            job.result = {"status": "failed", "message": str(err)}
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            job.expires = job.finished + self.ttl
+            with self.lock:
+                self.waiting -= 1
+            self._save(job)
+
+    def stop(self):
+        """
+        with the engine: running jobs finish and queued ones are dropped, so
+        the pool's threads don't hold the process up at exit
+        """
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _path(self, job_id):
+        """the job's spool file"""
+        return os.path.join(self.spool, job_id + ".json")
+
+    def _save(self, job):
+        """write the job to the spool (replacing it whole), if there is one"""
+        if not self.spool:
+            return
+        path = self._path(job.id)
+        try:
+            try:
+                data = json4store(job)
+            except (TypeError, ValueError) as err:
+                data = json4store(dict(job, result={
+                    "status": "failed", "message": "Cannot store result: " + str(err)}))
+            temp = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(temp, "w") as outfile:
+                outfile.write(data)
+            os.replace(temp, path)
+        except OSError as err:
+            log("error", job=job.id, spool=str(err))
+
+    def _load(self, job_id):
+        """a job from the spool, or None"""
+        if not self.spool or not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as infile:
+                job = Dict(json2data(infile.read()))
+        except (OSError, ValueError):
+            return None
+        if job.finished is None and not _alive(job.pid):
+            # its worker went away mid-run
+            job.finished = time.time()
+            job.expires = job.finished + self.ttl
+            job.status = "failed"
+            job.result = {"status": "failed", "message": "The job's worker exited"}
+            self._save(job)
+        return job
+
+    def get(self, job_id):
+        """a job, or None; one run by another worker comes from the spool"""
+        job = self.jobs.get(job_id) or self._load(job_id)
+        if job and job.expires and job.expires < time.time():
+            return None
+        return job
+
+    def prune(self):
+        """forget finished jobs past their ttl, and spool files nobody will"""
+        now = time.time()
+        with self.lock:
+            expired = [job.id for job in self.jobs.values()
+                       if job.expires and job.expires < now]
+            for job_id in expired:
+                del self.jobs[job_id]
+        if not self.spool:
+            return
+        for job_id in expired:
+            _remove(self._path(job_id))
+        # a file untouched for ttl is expired, or its worker died mid-run
+        try:
+            entries = [entry for entry in os.scandir(self.spool)
+                       if entry.name.endswith(".json")
+                       and entry.stat().st_mtime + self.ttl < now]
+        except OSError:
+            return
+        for entry in entries:
+            job = self._load(entry.name[:-5])
+            if job is None or (job.expires and job.expires < now):
+                _remove(entry.path)
+
+def _alive(pid):
+    """whether a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, TypeError):
+        pass
+    return True
+
+def _remove(path):
+    """delete a file that may already be gone"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,217 @@
+"""
+How loaded this process is: worker threads, queues and recent latency
+"""
+
+import time
+import threading
+import collections
+import cherrypy
+from .metrics import METRICS, BUCKETS
+from .logger import log
+
+################################################################################
+def thread_pool():
+    """the HTTP server's worker thread pool, or None before it starts"""
+    httpserver = getattr(cherrypy.server, 'httpserver', None)
+    return getattr(httpserver, 'requests', None)
+
+def workers():
+    """worker threads busy and idle, and connections waiting for one"""
+    pool = thread_pool()
+    if pool is None:
+        return dict(threads=0, busy=0, idle=0, queued=0, min=0, max=0)
+    # pylint: disable=protected-access
+    threads = len(pool._threads)
+    idle = pool.idle
+    return dict(threads=threads, busy=max(threads - idle, 0), idle=idle,
+                queued=pool.qsize, min=pool.min,
+                max=pool.max if 0 < pool.max < float('inf') else None)
+
+def accept_queue(port):
+    """
+    connections the kernel has accepted that the server hasn't picked up
+    yet; for a listening socket this is the rx_queue in /proc/net/tcp.
+    None where that can't be read.
+    """
+    port = "{:04X}".format(int(port))
+    depth = None
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table) as infile:
+                next(infile)
+                for line in infile:
+                    fields = line.split()
+                    # local address ends in :port, state 0A is LISTEN
+                    if fields[1].endswith(":" + port) and fields[3] == "0A":
+                        depth = (depth or 0) + int(fields[4].split(":")[1], 16)
+        except (OSError, IndexError, ValueError, StopIteration):
+            continue
+    return depth
+
+def in_flight(name='polyapi_facet_in_flight', key='facet'):
+    """{label: count} for a gauge"""
+    counters, _ = METRICS.snapshot()
+    return {dict(labels)[key]: value for (metric, labels), value in counters.items()
+            if metric == name and value}
+
+################################################################################
+def quantile(hist, fraction):
+    """
+    upper bound of the bucket holding the given fraction of a histogram's
+    observations (as kept by Metrics), or None if it is empty; the largest
+    bound stands in for anything beyond it
+    """
+    if not hist[-1]:
+        return None
+    want = fraction * hist[-1]
+    total = 0
+    for idx, bound in enumerate(BUCKETS):
+        total += hist[idx]
+        if total >= want:
+            return bound
+    return BUCKETS[-1]
+
+# pylint: disable=too-few-public-methods
+class Recent():
+    """
+    A histogram over (roughly) the last `window` seconds, as the difference
+    between the metric now and a snapshot taken about window seconds ago.
+    Snapshots are taken when asked, so it costs nothing in between.
+    """
+
+    def __init__(self, name='polyapi_request_seconds', window=60, exclude=()):
+        self.name = name
+        self.window = window
+        self.exclude = set(exclude) # routes that would skew it (health checks)
+        self.snapshots = collections.deque() # (time, merged histogram)
+        self.lock = threading.Lock()
+
+    def _merged(self):
+        """the metric now, across labels"""
+        _, histograms = METRICS.snapshot()
+        merged = [0] * (len(BUCKETS) + 2)
+        for (metric, labels), hist in histograms.items():
+            if metric == self.name and dict(labels).get('route') not in self.exclude:
+                for idx, value in enumerate(hist):
+                    merged[idx] += value
+        return merged
+
+    def histogram(self):
+        """observations made since the baseline snapshot"""
+        now = time.time()
+        current = self._merged()
+        with self.lock:
+            self.snapshots.append((now, current))
+            # keep the newest snapshot at least window old as the baseline
+            while len(self.snapshots) > 1 and self.snapshots[1][0] <= now - self.window:
+                self.snapshots.popleft()
+            base = self.snapshots[0][1]
+        return [value - base[idx] for idx, value in enumerate(current)]
+
+################################################################################
+# pylint: disable=too-many-instance-attributes
+class PoolSizer():
+    """
+    Grows and shrinks the HTTP worker thread pool between its min and max,
+    every few seconds, from what the last interval looked like.
+
+    Connections queued for a thread mean too few threads, unless facets
+    were holding the CPU: more threads then only contend for the GIL, so the
+    pool holds.  That is judged as facet thread CPU time per second of the
+    interval (in cores); past cpu_bound cores it counts as CPU bound.  CPU
+    that isolated facets' worker processes use doesn't count: it holds no
+    GIL here, and busy workers are when threads are needed to feed them.  The
+    fraction of facet time spent on the CPU is reported alongside, but can't
+    decide on its own: threads waiting for the GIL aren't on the CPU either.
+    Idle threads beyond `spare` for two intervals running are let go.
+    Decisions are logged as they happen and summed up for the status report.
+    """
+
+    def __init__(self, cpu_bound=0.8, spare=2, step=8):
+        self.cpu_bound = cpu_bound
+        self.spare = spare
+        self.step = step
+        self.last = None     # (time, facet cpu, facet wall) at the last tick
+        self.idle_ticks = 0
+        self.grew = 0
+        self.shrank = 0
+        self.held = 0
+        self.reason = None
+
+    def _facet_time(self):
+        """(cores, on-cpu fraction) of facet calls since the last tick, or Nones"""
+        counters, _ = METRICS.snapshot()
+        cpu = wall = 0
+        for (metric, _), value in counters.items():
+            if metric == 'polyapi_facet_cpu_seconds_total':
+                cpu += value
+            elif metric == 'polyapi_facet_wall_seconds_total':
+                wall += value
+        now = time.time()
+        last, self.last = self.last, (now, cpu, wall)
+        if last is None or now <= last[0]:
+            return None, None
+        cores = (cpu - last[1]) / (now - last[0])
+        if wall - last[2] <= 0:
+            return cores, None
+        return cores, min(1.0, (cpu - last[1]) / (wall - last[2]))
+
+    def tick(self):
+        """look at the last interval and resize"""
+        pool = thread_pool()
+        cores, on_cpu = self._facet_time()
+        if pool is None:
+            return
+        # shrinking by nothing culls the threads that have already stopped
+        pool.shrink(0)
+        # pylint: disable=protected-access
+        threads = len(pool._threads) - len(pool._pending_shutdowns)
+        idle = pool.idle
+        queued = pool.qsize
+        seen = "threads={} idle={} queued={} cores={} on_cpu={}".format(
+            threads, idle, queued, _round(cores), _round(on_cpu))
+
+        # a connection queued while threads sit idle is just passing through
+        if queued > idle:
+            self.idle_ticks = 0
+            if cores is not None and cores >= self.cpu_bound:
+                self.held += 1
+                self._decide("hold (cpu bound)", seen, threads, threads)
+            elif threads < pool.max:
+                pool.grow(min(queued - idle, self.step))
+                self.grew += 1
+                self._decide("grow", seen, threads, len(pool._threads))
+        elif idle > self.spare and threads > pool.min:
+            self.idle_ticks += 1
+            if self.idle_ticks >= 2:
+                amount = min(idle - self.spare, self.step, threads - pool.min)
+                # shrink() counts threads already told to stop against amount
+                pool.shrink(amount + len(pool._pending_shutdowns))
+                self.shrank += 1
+                self.idle_ticks = 0
+                self._decide("shrink", seen, threads, threads - amount)
+        else:
+            self.idle_ticks = 0
+
+    def _decide(self, action, seen, before, after):
+        """log a decision"""
+        self.reason = "{} {}->{} ({})".format(action, before, after, seen)
+        log("type=threadpool", action=action.split(" ")[0], threads=before,
+            target=after, seen='"' + seen + '"')
+
+    def report(self):
+        """for the status report: what was done since the last one"""
+        pool = thread_pool()
+        report = {
+            "pool_threads": len(pool._threads) if pool else 0, # pylint: disable=protected-access
+            "pool_grew": self.grew,
+            "pool_shrank": self.shrank,
+            "pool_held": self.held,
+            "pool_last": '"{}"'.format(self.reason) if self.reason else '-'
+        }
+        self.grew = self.shrank = self.held = 0
+        return report
+
+def _round(value):
+    """for a log line"""
+    return "-" if value is None else round(value, 2)
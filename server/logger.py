@@ -13,10 +13,14 @@ import sys
 import time
 import logging
 import logging.config
+import queue
+import atexit
 import datetime
+import threading
 import traceback
 import cherrypy._cplogging
-from . import SERVER
+from . import SERVER, tracing
+from .util import remote_addr, json4store
 
 ################################################################################
 # pylint: disable=protected-access
@@ -51,19 +55,25 @@ class CherryLog(cherrypy._cplogging.LogManager):
 
     ############################################################################
     def access(self):
-        """log access"""
+        """log access; for a streamed response, once it has been sent"""
+        if cherrypy.serving.response.stream:
+            # ahead of the trace ending (tracing.end), also on_end_request
+            cherrypy.serving.request.hooks.attach('on_end_request', self._access,
+                                                  failsafe=True, priority=10)
+            return
+        self._access()
+
+    def _access(self):
+        """the access line"""
         request = cherrypy.serving.request
-        remote = request.remote
         response = cherrypy.serving.response
         outheaders = response.headers
-        inheaders = request.headers
         if response.output_status is None:
             status = "-"
         else:
             status = response.output_status.split(" ".encode(), 1)[0]
 
-        remaddr = inheaders.get('X-Forwarded-For', None) or \
-                  remote.name or remote.ip
+        remaddr = remote_addr()
 
         if isinstance(status, bytes):
             status = status.decode()
@@ -75,12 +85,22 @@ class CherryLog(cherrypy._cplogging.LogManager):
             kwargs['token'] = login.token_name
             # Notes: insert other auth attributes?
 
+        ctx = tracing.current()
+        if ctx:
+            kwargs['ms'] = round(ctx.elapsed() * 1000, 3)
+            kwargs['spans'] = ctx.summary() or '-'
+
         log("type=http status=" + str(status),
             query=request.request_line,
             remote=remaddr,
             len=outheaders.get('Content-Length', '') or '-',
             **kwargs)
 
+        if ctx and tracing.EXPORT['on'] and kwargs['ms'] >= tracing.EXPORT['min_ms']:
+            log("type=trace", record=json4store(
+                ctx.record(status=status, request=request.request_line),
+                separators=(',', ':')))
+
 ################################################################################
 class Logger(logging.StreamHandler):
     """
@@ -152,6 +172,131 @@ def debug(*args, **kwargs):
             out.write(str(args))
             out.write(str(kwargs))
 
+###############################################################################
+def format_line(stamp, args, kwargs):
+    """one key=value log line"""
+    return " ".join((stamp,) + args) + " " + \
+           "".join("{}={} ".format(key, value) for key, value in kwargs.items()) + "\n"
+
+def _log_failed(args, kwargs):
+    """last resort when logging itself breaks; never raises"""
+    try:
+        with open("log_failed", "ta") as out:
+            out.write("\n\n--------------------------------------------------\n\n")
+            traceback.print_exc(file=out)
+            out.write(repr(args))
+            out.write(repr(kwargs))
+    except Exception: # pylint: disable=broad-except
+        pass
+
+def _unformatted(stamp, item):
+    """a record format_line choked on: log_failed gets it, the log its repr"""
+    _log_failed(item[1], item[2])
+    try:
+        record = repr((item[1], item[2]))
+    except Exception: # pylint: disable=broad-except
+        record = "unprintable"
+    return format_line(stamp or "-", ("type=log-failed",), {"record": record})
+
+###############################################################################
+class LogWriter():
+    """
+    Buffered logging.  Request threads only enqueue (time, args, kwargs); a
+    background thread formats whatever has queued up, up to `batch` records,
+    and writes it to stdout with a single write and flush.
+
+    When the queue is full the policy decides: "drop" discards the record
+    (reported later as a type=log-dropped line), "block" makes the caller
+    wait for room.  stop() drains everything queued before returning.  A
+    record that can't be formatted goes to log_failed and is written as its
+    repr; nothing stops the writer but stop().
+    """
+    dropped = 0
+    thread = None
+
+    def __init__(self, size=10000, batch=512, policy='drop'):
+        self.queue = queue.Queue(maxsize=size)
+        self.batch = batch
+        self.block = policy == 'block'
+        self.lock = threading.Lock()
+
+    def start(self):
+        """start the writer thread"""
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, args, kwargs):
+        """enqueue one record"""
+        try:
+            self.queue.put((time.time(), args, kwargs), block=self.block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def stop(self):
+        """write out everything queued and end the thread"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """writer loop"""
+        stamps = (None, None) # one isoformat per second, not per line
+        reported = 0
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            done = False
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+                try:
+                    second = int(item[0])
+                    if stamps[0] != second:
+                        stamps = (second, datetime.datetime.fromtimestamp(second).isoformat())
+                    lines.append(format_line(stamps[1], item[1], item[2]))
+                except Exception: # pylint: disable=broad-except
+                    lines.append(_unformatted(stamps[1], item))
+            dropped = self.dropped
+            if dropped != reported:
+                lines.append(format_line(stamps[1] or "-", ("type=log-dropped",),
+                                         {"count": dropped - reported}))
+                reported = dropped
+
+            try:
+                sys.stdout.write("".join(lines))
+                sys.stdout.flush()
+            except Exception: # pylint: disable=broad-except
+                _log_failed(batch, {})
+            if done:
+                return
+
+WRITER = None
+
+def start_writer(size=10000, batch=512, policy='drop'):
+    """switch log() to buffered writes; drained at engine stop and exit"""
+    global WRITER # pylint: disable=global-statement
+    writer = LogWriter(size=size, batch=batch, policy=policy)
+    writer.start()
+    WRITER = writer
+    cherrypy.engine.subscribe('stop', stop_writer)
+    atexit.register(stop_writer)
+
+def stop_writer():
+    """back to direct writes, after draining the queue"""
+    global WRITER # pylint: disable=global-statement
+    writer, WRITER = WRITER, None
+    if writer:
+        writer.stop()
+
 ###############################################################################
 def log(*args, **kwargs):
     """
@@ -161,9 +306,17 @@ def log(*args, **kwargs):
     x>> log(test="this is a test", x='this') # doctest: +ELLIPSIS
     - - [...] test='this is a test' x=this
     """
-    args = (datetime.datetime.now().replace(microsecond=0).isoformat(),) + args
+    if 'reqid' not in kwargs:
+        ctx = tracing.current()
+        if ctx:
+            kwargs['reqid'] = ctx.reqid
+    if WRITER and not SERVER:
+        WRITER.put(args, kwargs)
+        return
+    stamp = datetime.datetime.now().replace(microsecond=0).isoformat()
     try:
         if SERVER:
+            args = (stamp,) + args
             try:
                 if SERVER.conf.get('requestid'):
                     # note: danger: this should be injected by traffic management,
@@ -180,17 +333,10 @@ def log(*args, **kwargs):
                 SERVER.NOTIFY("Logging ServerError: " + traceback.format_exc())
             SERVER.NOTIFY(*args, **kwargs)
         else:
-            sys.stdout.write(" ".join(args) + " ")
-            for key, value in kwargs.items():
-                sys.stdout.write("{}={} ".format(key, value))
-            sys.stdout.write("\n")
+            sys.stdout.write(format_line(stamp, args, kwargs))
             sys.stdout.flush()
     except Exception: # pylint: disable=broad-except
-        with open("log_failed", "ta") as out:
-            out.write("\n\n--------------------------------------------------\n\n")
-            traceback.print_exc(file=out)
-            out.write(str(args))
-            out.write(str(kwargs))
+        _log_failed(args, kwargs)
 
 def abort(*msg):
     """
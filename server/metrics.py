@@ -0,0 +1,145 @@
+"""
+Request metrics: counters, gauges and fixed-bucket latency histograms
+"""
+
+import threading
+
+# latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> (kind, help)
+DESCRIBE = {
+    'polyapi_requests_total': ('counter', "HTTP requests by route, method and status"),
+    'polyapi_request_seconds': ('histogram', "HTTP request latency"),
+    'polyapi_requests_in_flight': ('gauge', "HTTP requests being handled"),
+    'polyapi_facet_calls_total': ('counter', "facet calls by outcome"),
+    'polyapi_facet_seconds': ('histogram', "facet call latency, auth and queueing excluded"),
+    'polyapi_facet_queue_seconds': ('histogram', "time facet calls waited for a concurrency slot"),
+    'polyapi_facet_in_flight': ('gauge', "facet calls running"),
+    'polyapi_facet_cpu_seconds_total': ('counter', "thread CPU time spent in facet calls"),
+    'polyapi_facet_wall_seconds_total': ('counter', "wall time spent in facet calls"),
+    'polyapi_facet_pool_cpu_seconds_total': ('counter',
+                                             "CPU time isolated facets' workers spent in calls"),
+}
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class Shard():
+    """one thread's accumulators; only its owner thread writes to it"""
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = dict()   # (name, labels) -> value
+        self.histograms = dict() # (name, labels) -> [bucket counts..., sum, count]
+
+class Metrics():
+    """
+    Metrics kept in per-thread shards, so recording never takes a lock or
+    contends with other threads.  A scrape merges all shards.  Gauges are
+    counters of +/- deltas, which merge the same way.
+
+    Labels are a tuple of (key, value) pairs.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def _shard(self):
+        """this thread's shard"""
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def count(self, name, labels, value=1):
+        """add to a counter (or gauge)"""
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    gauge = count
+
+    def observe(self, name, labels, seconds):
+        """record a latency"""
+        histograms = self._shard().histograms
+        key = (name, labels)
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = [0] * (len(BUCKETS) + 2)
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[idx] += 1
+                break
+        hist[-2] += seconds
+        hist[-1] += 1
+
+    def snapshot(self):
+        """merge every shard: (counters, histograms)"""
+        counters = dict()
+        histograms = dict()
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # copying a dict is atomic under the GIL; values may be a tick stale
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, hist in list(shard.histograms.items()):
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = list(hist)
+                else:
+                    for idx, value in enumerate(hist):
+                        merged[idx] += value
+        return counters, histograms
+
+    def render(self):
+        """text exposition format"""
+        counters, histograms = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in DESCRIBE:
+                kind, text = DESCRIBE[name]
+                lines.append("# HELP {} {}".format(name, text))
+                lines.append("# TYPE {} {}".format(name, kind))
+            described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append("{}{} {}".format(name, _labels(labels), _num(value)))
+
+        for (name, labels), hist in sorted(histograms.items()):
+            describe(name)
+            total = 0
+            for idx, bound in enumerate(BUCKETS):
+                total += hist[idx]
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels + (('le', _num(bound)),)), total))
+            lines.append("{}_bucket{} {}".format(
+                name, _labels(labels + (('le', '+Inf'),)), hist[-1]))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), round(hist[-2], 6)))
+            lines.append("{}_count{} {}".format(name, _labels(labels), hist[-1]))
+
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    """{key="value",...}"""
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                                                        .replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+def _num(value):
+    """render 1.0 as 1"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+METRICS = Metrics()
@@ -0,0 +1,222 @@
+"""
+Process-isolated facet execution
+"""
+
+import os
+import sys
+import time
+import queue
+import pickle
+import struct
+import signal
+import importlib
+import threading
+import traceback
+import multiprocessing
+from . import exceptions
+from .util import rss_mb, json4store
+from .metrics import METRICS
+from .logger import log
+
+# forkserver: workers are forked from a single-threaded server process, never
+# from this one, whose other threads may hold locks (logging, metrics, OpenMP
+# pools) that a forked child would inherit held
+_MP = multiprocessing.get_context('forkserver')
+_MP.set_forkserver_preload([__name__])
+
+################################################################################
+# pickle protocol 5 with out-of-band buffers: large contiguous arrays go over
+# the pipe as raw bytes rather than being copied into the pickle stream
+def send(conn, obj):
+    """send an object"""
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    conn.send_bytes(struct.pack("!I", len(buffers)) + data)
+    for buf in buffers:
+        conn.send_bytes(buf.raw())
+
+def recv(conn):
+    """receive an object"""
+    head = conn.recv_bytes()
+    count = struct.unpack("!I", head[:4])[0]
+    buffers = [conn.recv_bytes() for _ in range(count)]
+    return pickle.loads(memoryview(head)[4:], buffers=buffers)
+
+def _serve(conn, spec, context):
+    """
+    worker process: import and warm the facet, then loop on
+    (attr, event) in, (ok, result, streamed, cpu seconds, rss) out
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    path, modpath, warm = spec
+    sys.path.append(path)
+    mod = importlib.import_module(modpath)
+    if warm:
+        getattr(mod, warm)(context)
+    while True:
+        try:
+            msg = recv(conn)
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        attr, event = msg
+        streamed = False
+        cpu = time.process_time()
+        try:
+            result = getattr(mod, attr)(event, context)
+            if hasattr(result, '__next__'):
+                # chunks can't cross the pipe lazily; collect them here
+                result = list(result)
+                streamed = True
+            reply = (True, result)
+        except Exception as err: # pylint: disable=broad-except
+            try:
+                pickle.dumps(err)
+            except Exception: # pylint: disable=broad-except
+                err = exceptions.ServerError(str(err), 500)
+            reply = (False, (err, traceback.format_exc()))
+        send(conn, reply + (streamed, time.process_time() - cpu, rss_mb()))
+    os._exit(0) # pylint: disable=protected-access
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class Worker():
+    """parent's handle on one worker process"""
+    __slots__ = ('proc', 'conn', 'served', 'rss')
+
+    def __init__(self, spec, context):
+        self.conn, child = _MP.Pipe()
+        self.proc = _MP.Process(target=_serve, args=(child, spec, context), daemon=True)
+        self.proc.start()
+        child.close()
+        self.served = 0
+        self.rss = 0
+
+    def stop(self):
+        """ask it to exit, then make sure"""
+        try:
+            send(self.conn, None)
+        except (OSError, ValueError):
+            pass
+        self.proc.join(1)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+# pylint: disable=too-many-instance-attributes
+class FacetPool():
+    """
+    Long-lived worker processes running one facet.
+
+    A facet that leaks, holds the GIL or crashes in native code only takes
+    down its worker.  Workers are started lazily (by the forkserver) and
+    each imports and warms the facet from spec, (path, module, warm hook),
+    itself; they are replaced after max_requests calls or once their RSS
+    passes max_rss_mb (0 disables either), or when they die.  A call still
+    running after timeout seconds (0 waits forever) fails with a 504 and its
+    worker is killed.
+    Concurrency is bounded by the number of workers; callers wait for a free
+    one.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, spec, workers=2, max_requests=0, max_rss_mb=0,
+                 timeout=300):
+        self.name = name
+        self.spec = spec
+        self.size = max(1, int(workers))
+        self.max_requests = max_requests
+        self.max_rss_mb = max_rss_mb
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.closed = False
+        self.recycled = 0
+
+    def _checkout(self, context):
+        """an idle worker, starting one if the pool isn't full yet"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.started < self.size:
+                self.started += 1
+                try:
+                    return Worker(self.spec, context)
+                except Exception:
+                    self.started -= 1
+                    raise
+        return self.idle.get()
+
+    def _retire(self, worker, why):
+        """stop a worker; a replacement starts on demand"""
+        log("type=procpool", facet=self.name, pid=worker.proc.pid, retired=why,
+            served=worker.served, rss=round(worker.rss, 1))
+        worker.stop()
+        with self.lock:
+            self.started -= 1
+            self.recycled += 1
+        # wake one waiter so it can start the replacement
+        self.idle.put(None)
+
+    def call(self, context, attr, event):
+        """run the facet module's attr(event, context) in a worker"""
+        worker = self._checkout(context)
+        while worker is None: # a retirement wake-up
+            worker = self._checkout(context)
+
+        try:
+            send(worker.conn, (attr, event))
+            if not worker.conn.poll(self.timeout or None):
+                raise TimeoutError()
+            okay, result, streamed, cpu, worker.rss = recv(worker.conn)
+        except TimeoutError as err:
+            # hung, or just too slow: either way its state is unknown
+            self._retire(worker, "timeout")
+            raise exceptions.ServerError("Facet timed out", 504) from err
+        except (EOFError, OSError) as err:
+            self._retire(worker, "died")
+            raise exceptions.ServerError("Facet worker died: {}".format(err), 502)
+        except BaseException:
+            # an unpicklable event or reply: the pipe's state is unknown
+            self._retire(worker, "error")
+            raise
+
+        # the caller's thread only waited; the CPU was spent in the worker
+        METRICS.count('polyapi_facet_pool_cpu_seconds_total', (('facet', self.name),), cpu)
+        worker.served += 1
+        if self.closed:
+            self._retire(worker, "closed")
+        elif self.max_requests and worker.served >= self.max_requests:
+            self._retire(worker, "max_requests")
+        elif self.max_rss_mb and worker.rss > self.max_rss_mb:
+            self._retire(worker, "max_rss")
+        else:
+            self.idle.put(worker)
+
+        if not okay:
+            err, trace = result
+            log("error", facet=self.name, traceback=json4store(trace))
+            raise err
+        if streamed:
+            return iter(result)
+        return result
+
+    def close(self):
+        """stop idle workers now, busy ones as they finish"""
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                self._retire(worker, "closed")
+
+    def stats(self):
+        """pool occupancy"""
+        return dict(workers=self.started, size=self.size, recycled=self.recycled)
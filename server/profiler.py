@@ -0,0 +1,105 @@
+"""
+On-demand stack-sampling profiler
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+
+# thread ident -> what it is working on (a route, then a facet name).  Kept
+# whether or not anyone is profiling: a dict store and pop per request.
+ACTIVE = dict()
+
+def tag(label):
+    """mark this thread as working for label; returns the previous label"""
+    ident = threading.get_ident()
+    prev = ACTIVE.get(ident)
+    ACTIVE[ident] = label
+    return prev
+
+def untag(prev):
+    """restore the label tag() returned"""
+    if prev is None:
+        ACTIVE.pop(threading.get_ident(), None)
+    else:
+        ACTIVE[threading.get_ident()] = prev
+
+################################################################################
+class Sampler():
+    """
+    Samples every thread's Python stack from a single thread, at an interval,
+    for a fixed time.  Nothing is hooked into the threads being sampled, so
+    there is no cost while no sampler is running.
+
+    Samples are wall-clock: a thread blocked on I/O or a lock shows where it
+    waits.  Only tagged threads (those handling a request) are sampled unless
+    every_thread is set.  Facets in worker processes (isolate) show up as the
+    request thread waiting on their pool.
+    """
+    lock = threading.Lock()
+
+    def __init__(self, interval=0.01, every_thread=False):
+        self.interval = interval
+        self.every_thread = every_thread
+        self.counts = collections.Counter() # (label, stack) -> samples
+        self.ticks = 0
+        self.names = dict()
+        self.frames = dict() # code -> rendered frame, so repeat samples are cheap
+
+    def run(self, seconds):
+        """sample for seconds; only one sampler runs at a time"""
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            me = threading.get_ident()
+            stop = time.time() + seconds
+            while time.time() < stop:
+                if self.every_thread and self.ticks % 100 == 0:
+                    self.names = {thread.ident: thread.name
+                                  for thread in threading.enumerate()}
+                # pylint: disable=protected-access
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    label = ACTIVE.get(ident)
+                    if label is None:
+                        if not self.every_thread:
+                            continue
+                        label = self.names.get(ident, "thread-{}".format(ident))
+                    self.counts[(label, self._stack(frame))] += 1
+                self.ticks += 1
+                time.sleep(self.interval)
+        finally:
+            self.lock.release()
+        return True
+
+    def collapsed(self):
+        """'label;outer;...;inner count' lines, as flamegraph.pl takes them"""
+        return "".join("{};{} {}\n".format(label.replace(";", ":"), stack, count)
+                       for (label, stack), count in self.counts.most_common())
+
+    def by_label(self):
+        """{label: {samples, stacks: {stack: count}}}"""
+        out = dict()
+        for (label, stack), count in self.counts.most_common():
+            entry = out.setdefault(label, dict(samples=0, stacks=dict()))
+            entry['samples'] += count
+            entry['stacks'][stack] = count
+        return out
+
+    def _stack(self, frame):
+        """a collapsed stack, outermost frame first"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self.frames.get(code)
+            if name is None:
+                name = self.frames[code] = "{} ({}:{})".format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno).replace(";", ":")
+            names.append(name)
+            frame = frame.f_back
+        names.reverse()
+        return ";".join(names)
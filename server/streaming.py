@@ -0,0 +1,131 @@
+"""
+Streamed (chunked) facet responses and request ingestion
+"""
+
+import tempfile
+import traceback
+import cherrypy
+from . import exceptions
+from .util import json4store, json4wire, json2data
+from .logger import log
+
+NDJSON = 'application/x-ndjson'
+
+################################################################################
+def is_stream(value):
+    """a facet result to stream: any iterator (a generator, usually)"""
+    return hasattr(value, '__next__')
+
+def respond(chunks):
+    """
+    Stream an iterator of result chunks with chunked transfer encoding: one
+    JSON document per line if the client accepts NDJSON, else a JSON array.
+
+    The status line is long gone if the facet fails part way, so a failure
+    is sent as a final {"status": "failed"} record.
+    """
+    response = cherrypy.serving.response
+    response.stream = True
+    if NDJSON in cherrypy.serving.request.headers.get('Accept', ''):
+        response.headers['Content-Type'] = NDJSON
+        return _ndjson(chunks)
+    return _array(chunks)
+
+def _failed(err):
+    """log a mid-stream failure and make its closing record"""
+    log("error", traceback=json4store(traceback.format_exc()))
+    return json4wire({"status": "failed", "message": str(err)})
+
+def _close(chunks):
+    """let the facet's iterator go, read to the end or not"""
+    close = getattr(chunks, 'close', None)
+    if close:
+        close()
+
+def _ndjson(chunks):
+    """NDJSON body"""
+    try:
+        for chunk in chunks:
+            yield json4wire(chunk) + b"\n"
+    except Exception as err: # pylint: disable=broad-except
+        yield _failed(err) + b"\n"
+    finally:
+        _close(chunks)
+
+def _array(chunks):
+    """JSON array body"""
+    yield b"["
+    sep = b""
+    try:
+        for chunk in chunks:
+            yield sep + json4wire(chunk)
+            sep = b","
+    except Exception as err: # pylint: disable=broad-except
+        yield sep + _failed(err)
+    finally:
+        _close(chunks)
+    yield b"]"
+
+################################################################################
+class RecordStream():
+    """
+    A request body handed to the facet as an iterator of records, one JSON
+    document per line (NDJSON), parsed only as the facet consumes them.
+
+    The body may not exceed max_bytes (413 part way through otherwise).  With
+    spool_bytes set the raw body is first copied to a SpooledTemporaryFile,
+    kept in memory up to that size and spilled to disk beyond it; that frees
+    the client early and lets the facet iterate more than once.
+    """
+    chunk = 1048576
+
+    def __init__(self, rfile, max_bytes, spool_bytes=0):
+        self.rfile = rfile
+        self.max_bytes = max_bytes
+        self.spool = None
+        if spool_bytes:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+            self._fill()
+
+    def _too_big(self):
+        """refuse the body"""
+        raise exceptions.ServerError("Request body exceeds {} bytes"
+                                     .format(self.max_bytes), 413)
+
+    def _fill(self):
+        """copy the body to the spool"""
+        size = 0
+        while True:
+            block = self.rfile.read(self.chunk)
+            if not block:
+                break
+            size += len(block)
+            if size > self.max_bytes:
+                self._too_big()
+            self.spool.write(block)
+
+    def __iter__(self):
+        if self.spool:
+            self.spool.seek(0)
+            for line in self.spool:
+                if line.strip():
+                    yield json2data(line)
+            return
+
+        size = 0
+        while True:
+            # never buffer more than the limit, however long the line
+            line = self.rfile.readline(self.max_bytes - size + 1)
+            if not line:
+                return
+            size += len(line)
+            if size > self.max_bytes:
+                self._too_big()
+            if line.strip():
+                yield json2data(line)
+
+    def close(self):
+        """drop the spool"""
+        if self.spool:
+            self.spool.close()
+            self.spool = None
@@ -0,0 +1,69 @@
+"""
+Failed-auth throttling
+"""
+
+import math
+import time
+import threading
+
+################################################################################
+class AuthThrottle():
+    """
+    Per-client tracking of failed authentication.
+
+    A client gets `burst` failures for free within `window` seconds.  Each
+    failure past that blocks the client for twice as long as the last one
+    (1s, 2s, 4s ... up to max_delay).  The window runs from the later of the
+    last failure and the end of the last block, so a client keeps climbing
+    however long its blocks get.  Blocked clients are refused with 429 and
+    Retry-After before their body is read or any auth work is done, so no
+    worker thread is ever parked on their behalf.
+    """
+    burst = 5
+    window = 60
+    max_delay = 300
+
+    def __init__(self, burst=5, window=60, max_delay=300):
+        self.configure(burst=burst, window=window, max_delay=max_delay)
+        self.lock = threading.Lock()
+        self.clients = dict() # addr -> [failures, last failure, blocked until]
+
+    def configure(self, burst=None, window=None, max_delay=None):
+        """update limits from config"""
+        if burst is not None:
+            self.burst = int(burst)
+        if window is not None:
+            self.window = window
+        if max_delay is not None:
+            self.max_delay = max_delay
+
+    def retry_after(self, client):
+        """seconds the client must wait, or 0 when it may proceed"""
+        entry = self.clients.get(client)
+        if not entry:
+            return 0
+        wait = entry[2] - time.time()
+        if wait <= 0:
+            return 0
+        return int(math.ceil(wait))
+
+    def failed(self, client):
+        """record a failure"""
+        now = time.time()
+        with self.lock:
+            entry = self.clients.get(client)
+            if not entry or max(entry[1], entry[2]) + self.window < now:
+                entry = self.clients[client] = [0, now, 0]
+            entry[0] += 1
+            entry[1] = now
+            over = entry[0] - self.burst
+            if over > 0:
+                entry[2] = now + min(self.max_delay, 2 ** min(over - 1, 32))
+
+    def prune(self):
+        """forget clients with nothing recent"""
+        now = time.time()
+        with self.lock:
+            for client in [client for client, entry in self.clients.items()
+                           if max(entry[1], entry[2]) + self.window < now]:
+                del self.clients[client]
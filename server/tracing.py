@@ -0,0 +1,117 @@
+"""
+Per-request context: request ids and timed phases (spans)
+"""
+
+import os
+import time
+import random
+import itertools
+import threading
+import contextlib
+import cherrypy
+
+# ids are a per-process random prefix and a counter; next() on a count is a
+# single C call, so threads need no lock to share it
+PREFIX = "{:08x}".format(random.getrandbits(32))
+COUNTER = itertools.count(1)
+
+def _reseed():
+    """pre-forked workers each get their own prefix"""
+    global PREFIX, COUNTER # pylint: disable=global-statement
+    PREFIX = "{:08x}".format(random.getrandbits(32))
+    COUNTER = itertools.count(1)
+
+os.register_at_fork(after_in_child=_reseed)
+
+def new_id():
+    """a request id, unique across threads and processes"""
+    return "{}-{:x}".format(PREFIX, next(COUNTER))
+
+# export a trace record (logged as type=trace) for requests taking min_ms or more
+EXPORT = dict(on=False, min_ms=0)
+
+def configure(export=False, min_ms=0):
+    """from server.conf.trace"""
+    EXPORT['on'] = bool(export)
+    EXPORT['min_ms'] = min_ms
+
+################################################################################
+class Trace():
+    """one request's id and spans: (name, offset from start, duration) seconds"""
+    __slots__ = ('reqid', 'started', 'wall', 'spans')
+
+    def __init__(self, reqid=None):
+        self.reqid = reqid or new_id()
+        self.started = time.perf_counter()
+        self.wall = time.time()
+        self.spans = []
+
+    def add(self, name, secs, offset=None):
+        """a span timed elsewhere; by default it ended just now"""
+        if offset is None:
+            offset = time.perf_counter() - self.started - secs
+        self.spans.append((name, offset, secs))
+
+    def elapsed(self):
+        """seconds since the request started"""
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """'auth:0.41,facet:12.3' milliseconds per phase, for a log line"""
+        totals = dict()
+        for name, _, secs in self.spans:
+            totals[name] = totals.get(name, 0) + secs
+        return ",".join("{}:{}".format(name, round(secs * 1000, 3))
+                        for name, secs in totals.items())
+
+    def record(self, **extra):
+        """the exported form"""
+        return dict(extra, reqid=self.reqid, start=round(self.wall, 6),
+                    ms=round(self.elapsed() * 1000, 3),
+                    spans=[{"name": name, "at_ms": round(offset * 1000, 3),
+                            "ms": round(secs * 1000, 3)}
+                           for name, offset, secs in self.spans])
+
+################################################################################
+CURRENT = threading.local()
+
+def begin(reqid=None):
+    """start a trace for this thread"""
+    trace = CURRENT.trace = Trace(reqid)
+    return trace
+
+def current():
+    """this thread's trace, or None"""
+    return getattr(CURRENT, 'trace', None)
+
+def end():
+    """forget this thread's trace"""
+    CURRENT.trace = None
+
+def add(name, secs):
+    """add a span timed elsewhere to the current trace, if any"""
+    trace = getattr(CURRENT, 'trace', None)
+    if trace is not None:
+        trace.add(name, secs)
+
+@contextlib.contextmanager
+def span(name):
+    """time the block as a span of the current trace, if any"""
+    trace = getattr(CURRENT, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, started - trace.started,
+                            time.perf_counter() - started))
+
+################################################################################
+def _begin_request():
+    """every request gets a trace; its id is also request.reqid"""
+    cherrypy.serving.request.reqid = begin().reqid
+    cherrypy.serving.request.hooks.attach('on_end_request', end)
+
+cherrypy.tools.trace = cherrypy.Tool('on_start_resource', _begin_request, priority=0)
@@ -28,9 +28,16 @@ plus basic REST handlers.
 import base64
 import re
 import json
+import resource
 import cherrypy
 from . import exceptions
 
+# a C codec if there is one; the stdlib json module otherwise
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None # pylint: disable=invalid-name
+
 ################################################################################
 def secureheaders():
     """Establish secure headers"""
@@ -43,21 +50,25 @@ cherrypy.tools.secureheaders = cherrypy.Tool('before_finalize', secureheaders, p
 
 ###############################################################################
 RX_TOK = re.compile(r'[^a-z0-9-]')
-def get_jti(in_jwt):
+def get_jwt_payload(in_jwt):
     """
-    Pull the JTI from the payload of the jwt without verifying signature.
+    Decode the payload of a jwt without verifying signature.
     Dangerous, not good unless secondary verification matches.
     """
     payload_raw = in_jwt.split(".")[1]
-
-    missing_padding = 4 - len(payload_raw) % 4
-    if missing_padding:
-        payload_raw += '=' * missing_padding
+    payload_raw += '=' * (-len(payload_raw) % 4)
     try:
-        data = json2data(base64.b64decode(payload_raw))
+        return json2data(base64.urlsafe_b64decode(payload_raw))
     except:
         raise ValueError("Error decoding JWT: {}".format(in_jwt))
 
+def get_jti(in_jwt):
+    """
+    Pull the JTI from the payload of the jwt without verifying signature.
+    Dangerous, not good unless secondary verification matches.
+    """
+    data = get_jwt_payload(in_jwt)
+
     token_id = str(data.get('jti', ''))
     if RX_TOK.search(token_id):
         raise ValueError("Invalid User ID: {}".format(token_id))
@@ -65,18 +76,82 @@ def get_jti(in_jwt):
     return token_id
 
 ################################################################
+def _json_default(obj):
+    """
+    Encode what the codec doesn't know natively.  NumPy arrays and scalars
+    are native to orjson; pandas frames go out column-oriented, as
+    {column: [values]}, and series as a list.
+    """
+    kind = type(obj).__module__.split(".")[0]
+    if kind == 'pandas':
+        if hasattr(obj, 'columns'):
+            return {str(col): obj[col].to_numpy() if orjson else obj[col].tolist()
+                    for col in obj.columns}
+        if hasattr(obj, 'to_numpy'):
+            return obj.to_numpy() if orjson else obj.tolist()
+    if kind == 'numpy':
+        # stdlib fallback, or an array orjson can't take (non-contiguous etc)
+        return obj.tolist() if hasattr(obj, 'tolist') else obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+# orjson differs from the stdlib in two ways that show: NaN and Infinity are
+# written as null (the stdlib writes NaN, which isn't JSON), and it refuses
+# ints past 64 bits, so a document with one is written by the stdlib instead
+if orjson:
+    _ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def json4wire(data):
+    """Json output for the wire, as bytes"""
+    if orjson:
+        try:
+            return orjson.dumps(data, default=_json_default, option=_ORJSON_OPTS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, default=_json_default).encode()
+
 def json4human(data):
     """Json output for humans"""
-    return json.dumps(data, indent=2, sort_keys=True)
+    if orjson:
+        try:
+            return orjson.dumps(data, default=_json_default,
+                                option=_ORJSON_OPTS | orjson.OPT_INDENT_2 |
+                                orjson.OPT_SORT_KEYS).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, indent=2, sort_keys=True, default=_json_default)
 
 def json4store(data, **kwargs):
     """Json output for storage"""
+    # orjson output is always compact; anything fancier goes to the stdlib
+    if orjson and set(kwargs) <= {'sort_keys', 'separators'} and \
+       kwargs.get('separators', (',', ':')) == (',', ':'):
+        option = _ORJSON_OPTS
+        if kwargs.get('sort_keys'):
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(data, default=_json_default, option=option).decode()
+        except orjson.JSONEncodeError:
+            pass
+    kwargs.setdefault('default', _json_default)
     return json.dumps(data, **kwargs)
 
 def json2data(string):
-    """json to its python representation"""
+    """json (str or bytes) to its python representation"""
+    if orjson:
+        return orjson.loads(string)
     return json.loads(string)
 
+################################################################################
+def json_processor(entity):
+    """cherrypy.tools.json_in processor using the fast codec"""
+    if not entity.headers.get('Content-Length', ''):
+        raise cherrypy.HTTPError(411)
+    body = entity.fp.read()
+    with cherrypy.HTTPError.handle(ValueError, 400, 'Invalid JSON document'):
+        cherrypy.serving.request.json = json2data(body)
+
 ################################################################################
 def get_json_body():
     """Helper to get JSON content"""
@@ -88,6 +163,23 @@ def get_json_body():
         except TypeError:
             raise exceptions.ServerError("Unable to load JSON content", 400)
 
-    if isinstance(body, str): # or isinstance(body, unicode):
+    if isinstance(body, (str, bytes)):
         return json2data(body)
     return body
+
+################################################################################
+def remote_addr():
+    """client address of the current request, as the access log reports it"""
+    request = cherrypy.serving.request
+    return request.headers.get('X-Forwarded-For', None) or \
+           request.remote.name or request.remote.ip
+
+################################################################################
+def rss_mb():
+    """current resident set size in MB (peak, where /proc is missing)"""
+    try:
+        with open("/proc/self/statm") as infile:
+            pages = int(infile.read().split()[1])
+        return pages * resource.getpagesize() / 1048576
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
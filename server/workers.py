@@ -0,0 +1,139 @@
+"""
+Pre-forked worker processes sharing one listening socket
+"""
+
+import os
+import sys
+import errno
+import time
+import signal
+import socket
+import setproctitle
+from .logger import log
+
+# systemd socket activation hands the listener over as fd 3 with LISTEN_PID
+# set; cheroot and CherryPy both honor that, so workers need no patching.
+LISTEN_FD = 3
+
+################################################################################
+class Supervisor():
+    """
+    Bind the listening socket once, then fork workers which inherit it.
+
+    Call bind() before the facets are imported, so the listener takes
+    LISTEN_FD before anything of theirs can, and start() after: workers
+    share the model memory copy-on-write instead of each loading their own
+    copy.  Keep the Supervisor referenced, as it owns the listener.  start()
+    only returns inside a worker; the supervisor stays in its wait loop,
+    restarting any worker that dies, until it is told to stop.
+    """
+    count = 0
+    sock = None
+    children = None
+    running = False
+    respawn_delay = 1
+
+    def __init__(self, count, host, port):
+        self.count = count
+        self.host = host
+        self.port = port
+        self.children = dict()
+
+    def bind(self):
+        """create the shared listener, as LISTEN_FD"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(socket.SOMAXCONN)
+        if sock.fileno() != LISTEN_FD:
+            try:
+                os.fstat(LISTEN_FD)
+            except OSError:
+                pass # free, as it should be
+            else:
+                # dup2 would silently close whatever holds it
+                sock.close()
+                raise OSError(errno.EBUSY, "fd {} is already open; the workers' "
+                              "listening socket needs it".format(LISTEN_FD))
+            os.dup2(sock.fileno(), LISTEN_FD)
+            sock.close()
+            sock = socket.socket(fileno=LISTEN_FD)
+        self.sock = sock
+
+    def start(self):
+        """fork the workers; returns only in a worker process"""
+        if self.sock is None:
+            self.bind()
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        log("type=supervisor", workers=self.count, port=self.port, pid=os.getpid())
+
+        for slot in range(self.count):
+            if self.spawn(slot) == 0:
+                return
+
+        if self.supervise():
+            return # a respawned worker
+        log("type=supervisor", msg="all workers exited")
+        sys.exit(0)
+
+    def spawn(self, slot):
+        """fork one worker; returns 0 in the child"""
+        pid = os.fork()
+        if pid == 0:
+            self._become_worker(slot)
+            return 0
+        self.children[pid] = Slot(slot, time.time())
+        return pid
+
+    def supervise(self):
+        """wait on the workers and replace any that die; True in a respawn"""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            slot = self.children.pop(pid, None)
+            if slot is None:
+                continue
+            if not self.running:
+                continue
+
+            log("type=supervisor", msg="worker died", pid=pid, slot=slot.num,
+                status=os.waitstatus_to_exitcode(status))
+            # don't spin if a worker dies right out of the gate
+            if time.time() - slot.started < self.respawn_delay:
+                time.sleep(self.respawn_delay)
+            if self.spawn(slot.num) == 0:
+                return True
+        return False
+
+    def _become_worker(self, slot):
+        """post-fork setup inside the worker; the server sets its own SIGTERM handler"""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.running = False
+        self.children = dict()
+        os.environ['LISTEN_PID'] = str(os.getpid())
+
+        setproctitle.setproctitle('polyapi worker {}'.format(slot)) # pylint: disable=no-member,c-extension-no-member
+
+    # pylint: disable=unused-argument
+    def _stop(self, signum, frame):
+        """forward a shutdown to the workers"""
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+# pylint: disable=too-few-public-methods
+class Slot():
+    """bookkeeping for one worker"""
+    __slots__ = ('num', 'started')
+
+    def __init__(self, num, started):
+        self.num = num
+        self.started = started